@@ -0,0 +1,127 @@
+"""
+Local stand-ins for the RC API and the GeoNames search service, serving
+a synthetic directory from benchmarks.synthetic
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import json
+import threading
+import time
+
+
+def geonames_query_text(place):
+    """Returns the search text update_data.geonames_request sends for one
+    of the synthetic locations, lowercased."""
+    parts = place['name'].split(', ')
+    return ' '.join(parts).casefold()
+
+
+class FakeUpstreams:
+    """Serves the synthetic profiles and locations over HTTP, as
+    /api/v1/profiles, /api/v1/profiles/me and /api/v1/locations of the RC
+    API, and as /searchJSON of GeoNames. Every response is delayed by
+    `latency` seconds to stand in for the network."""
+
+    def __init__(self, profiles, locations, latency=0.0):
+        self.profiles = profiles
+        self.locations = locations
+        self.latency = latency
+        self.requests = 0
+        self._geonames = {geonames_query_text(place): place for place in locations}
+        self._server = None
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                url = urlparse(self.path)
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                fake.requests += 1
+                if fake.latency:
+                    time.sleep(fake.latency)
+
+                body = fake.respond(url.path, params)
+                if body is None:
+                    self.send_error(404)
+                    return
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        ThreadingHTTPServer.daemon_threads = True
+        ThreadingHTTPServer.request_queue_size = 256
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True,
+                         name='fake-upstreams').start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self._server.server_port}'
+
+    @property
+    def rc_api_url(self):
+        return self.base_url + '/api/v1/'
+
+    @property
+    def geonames_url(self):
+        return self.base_url + '/searchJSON'
+
+    def respond(self, path, params):
+        "Returns the JSON body for a request, or None for an unknown path."
+        if path == '/api/v1/profiles/me':
+            return self.profiles[0]
+        if path == '/api/v1/profiles':
+            offset = int(params.get('offset', 0))
+            limit = int(params.get('limit', 50))
+            return self.profiles[offset:offset + limit]
+        if path == '/api/v1/locations':
+            query = params.get('query', '').casefold()
+            limit = int(params.get('limit', 10))
+            return [{
+                'id': place['id'],
+                'name': place['name'],
+                'short_name': place['short_name'],
+                'type': 'city' if ', ' in place['name'] else 'country',
+            } for place in self.locations if query in place['name'].casefold()][:limit]
+        if path == '/searchJSON':
+            place = self._geonames.get(' '.join(params.get('q', '').split()).casefold())
+            if place is None:
+                return {'totalResultsCount': 0, 'geonames': []}
+            return {'totalResultsCount': 1, 'geonames': [{
+                'geonameId': place['id'],
+                'name': place['short_name'],
+                'lat': str(place['lat']),
+                'lng': str(place['lng']),
+                'adminCode1': '',
+                'countryCode': f"Z{place['country_index']}",
+                'fcl': 'P' if ', ' in place['name'] else 'A',
+            }]}
+        return None
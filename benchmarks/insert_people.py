@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+'''
+Compare the bulk profile writer in update_data.py with one-row-at-a-time
+inserts, which is how profiles were written before.
+
+Every run writes synthetic profiles to the database in DATABASE_URL inside
+a transaction that is rolled back, so it can be pointed at a development
+database. The schema must already exist.
+'''
+
+import argparse
+import logging
+import os
+import sys
+import time
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('GEONAMES_USERNAME', 'benchmark')
+
+from update_data import ProfileWriter, get_env_var, normalize_people  # noqa: E402
+from benchmarks.synthetic import generate_profiles  # noqa: E402
+
+
+class RowProfileWriter(ProfileWriter):
+    "Writes one INSERT per row, as update_data did before bulk writes."
+
+    def __call__(self, rows):
+        cursor = self.cursor
+
+        for person_id, name, image_url in rows.people:
+            cursor.execute("INSERT INTO people" +
+                           " (person_id, name, image_url)" +
+                           " VALUES (%s, %s, %s)" +
+                           " ON CONFLICT (person_id) DO UPDATE SET" +
+                           " name = %s," +
+                           " image_url = %s" +
+                           " WHERE people.person_id = %s",
+                           [person_id, name, image_url, name, image_url, person_id])
+            self.row_count += 1
+        self.people_count += len(rows.people)
+
+        for location_id, name, short_name in rows.locations:
+            if (location_id in self.processed_locations):
+                continue
+            self.processed_locations.add(location_id)
+            cursor.execute("INSERT INTO locations" +
+                           " (location_id, name, short_name)" +
+                           " VALUES (%s, %s, %s)" +
+                           " ON CONFLICT (location_id) DO NOTHING",
+                           [location_id, name, short_name])
+            self.row_count += 1
+
+        for person_id, location_id, affiliation_type in rows.affiliations:
+            cursor.execute("INSERT INTO location_affiliations" +
+                           " (person_id, location_id, affiliation_type)" +
+                           " VALUES (%s, %s, %s)" +
+                           " ON CONFLICT (person_id, affiliation_type)" +
+                           " DO UPDATE SET" +
+                           " location_id = %s" +
+                           " WHERE location_affiliations.person_id = %s",
+                           [person_id, location_id, affiliation_type, location_id, person_id])
+            self.row_count += 1
+
+        for batch_id, name, short_name in rows.batches:
+            if (batch_id in self.processed_batches):
+                continue
+            self.processed_batches.add(batch_id)
+            cursor.execute("INSERT INTO batches " +
+                           " (batch_id, name, short_name)" +
+                           " VALUES (%s, %s, %s)" +
+                           " ON CONFLICT (batch_id) DO NOTHING",
+                           [batch_id, name, short_name])
+            self.row_count += 1
+
+        for stint in rows.stints:
+            cursor.execute("INSERT INTO stints" +
+                           " (person_id, batch_id, stint_type," +
+                           "  start_date, end_date, title)" +
+                           " VALUES (%s, %s, %s, %s, %s, %s)" +
+                           " ON CONFLICT (person_id, start_date) DO NOTHING",
+                           list(stint))
+            self.row_count += 1
+
+
+def time_writer(connection, writer_class, pages):
+    "Returns rows written and seconds taken by one writer, then rolls back."
+    cursor = connection.cursor()
+    writer = writer_class(cursor)
+    start = time.perf_counter()
+    for page in pages:
+        writer(page)
+    elapsed = time.perf_counter() - start
+    connection.rollback()
+    return writer.row_count, elapsed
+
+
+def benchmark(database_url, people, page_size, repeat):
+    "Returns {writer name: best rows/second} for synthetic profiles."
+    profiles = generate_profiles(people=people, locations=max(10, people // 20))
+    pages = [normalize_people(profiles[i:i + page_size])
+             for i in range(0, len(profiles), page_size)]
+
+    connection = psycopg2.connect(database_url)
+    results = {}
+    for name, writer_class in (('row', RowProfileWriter), ('bulk', ProfileWriter)):
+        best = None
+        for _ in range(repeat):
+            rows, elapsed = time_writer(connection, writer_class, pages)
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {'rows': rows, 'seconds': best, 'rows_per_second': rows / best}
+        logging.info('%s: %s rows in %.3fs (%.0f rows/s)',
+                     name, rows, best, rows / best)
+    connection.close()
+
+    logging.info('Bulk writes are %.1fx faster',
+                 results['bulk']['rows_per_second'] / results['row']['rows_per_second'])
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark(get_env_var('DATABASE_URL'), args.people, args.page_size, args.repeat)
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+'''
+Compare the latency of resolving /api/locations/<id> with the single
+location_document() query against the four sequential queries that the
+endpoint used to make (alias, people, geolocation, country population).
+
+Synthetic locations, people and aliases are written to the database in
+DATABASE_URL inside a transaction that is rolled back, so it can be
+pointed at a development database. The schema must already exist.
+'''
+
+import argparse
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+os.environ.setdefault('GEONAMES_USERNAME', 'benchmark')
+
+from update_data import (ProfileWriter, get_env_var, insert_geo_data,  # noqa: E402
+                         normalize_people, refresh_aggregates)
+from benchmarks.synthetic import generate_locations, generate_profiles  # noqa: E402
+
+
+def legacy_lookup(cursor, location_id):
+    "Resolves a location the way get_location did before location_document."
+    cursor.execute("""SELECT preferred_location_id
+                      FROM location_aliases
+                      WHERE location_id = %s""", [location_id])
+    alias = cursor.fetchone()
+    if alias:
+        location_id = alias[0]
+
+    cursor.execute("""SELECT
+                        location_id,
+                        location_name,
+                        type,
+                        lat,
+                        lng,
+                        city_count,
+                        total_population,
+                        person_list
+                      FROM geolocations_people_and_stints_agg
+                      WHERE location_id = %s""", [location_id])
+    x = cursor.fetchone()
+    if x:
+        return {
+            'location_id': x[0],
+            'location_name': x[1],
+            'type': x[2],
+            'lat': x[3],
+            'lng': x[4],
+            'city_count': x[5],
+            'total_population': x[6],
+            'has_rc_people': True,
+            'person_list': x[7]
+        }
+
+    cursor.execute("""SELECT
+                        location_id,
+                        name,
+                        type,
+                        lat,
+                        lng
+                      FROM geolocations
+                      WHERE location_id = %s""", [location_id])
+    x = cursor.fetchone()
+    if not x:
+        return None
+    location = {
+        'location_id': x[0],
+        'location_name': x[1],
+        'type': x[2],
+        'lat': x[3],
+        'lng': x[4],
+        'has_rc_people': False
+    }
+    if location['type'] == 'city':
+        return location
+
+    cursor.execute("""SELECT
+                        location_id,
+                        city_count,
+                        total_population
+                      FROM geolocations_popl_by_country_agg
+                      WHERE location_id = %s""", [location_id])
+    x = cursor.fetchone()
+    if x:
+        location.update({'location_id': x[0], 'city_count': x[1],
+                         'total_population': x[2]})
+    return location
+
+
+def document_lookup(cursor, location_id):
+    "Resolves a location with the location_document() function."
+    cursor.execute("SELECT location_document(%s)", [location_id])
+    return cursor.fetchone()[0]
+
+
+def load_synthetic_data(cursor, people, locations, seed):
+    """Writes synthetic profiles, geolocates every synthetic location and
+    aliases a few of them, then returns the location ids."""
+    profiles = generate_profiles(people=people, locations=locations, seed=seed)
+    writer = ProfileWriter(cursor)
+    writer(normalize_people(profiles))
+
+    # generate_profiles draws its locations first from a generator with
+    # the same seed, so this returns the same ones
+    places = generate_locations(locations, random.Random(seed))
+    countries = max(1, locations // 11)
+    for place in places:
+        cursor.execute("INSERT INTO locations (location_id, name, short_name)" +
+                       " VALUES (%s, %s, %s)" +
+                       " ON CONFLICT (location_id) DO NOTHING",
+                       [place['id'], place['name'], place['short_name']])
+        is_country = place['id'] < 1000 + countries
+        insert_geo_data(cursor, {
+            'location_id': place['id'],
+            'name': place['name'],
+            'type': 'country' if is_country else 'city',
+            'subdivision_derived': '',
+            'subdivision_code': '',
+            'country_name': f"Country {place['country_index']}",
+            'country_code': f"Z{place['country_index']}",
+            'lat': place['lat'],
+            'lng': place['lng'],
+        })
+
+    # Alias every tenth city to the one before it
+    aliases = [(place['id'], place['id'] - 1)
+               for place in places[countries + 1::10]]
+    for location_id, preferred_id in aliases:
+        cursor.execute("INSERT INTO location_aliases" +
+                       " (location_id, preferred_location_id)" +
+                       " VALUES (%s, %s)" +
+                       " ON CONFLICT (location_id) DO NOTHING",
+                       [location_id, preferred_id])
+
+    refresh_aggregates(cursor)
+    return [place['id'] for place in places]
+
+
+def time_lookups(cursor, lookup, location_ids):
+    "Returns the latency of each lookup, in milliseconds."
+    latencies = []
+    for location_id in location_ids:
+        start = time.perf_counter()
+        lookup(cursor, location_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def summarize(latencies):
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': percentiles[49],
+        'p99_ms': percentiles[98],
+    }
+
+
+def benchmark(database_url, people, locations, lookups, seed=0):
+    "Returns {lookup name: latency summary} for random location lookups."
+    connection = psycopg2.connect(database_url)
+    cursor = connection.cursor()
+    try:
+        location_ids = load_synthetic_data(cursor, people, locations, seed)
+        rng = random.Random(seed)
+        sample = [rng.choice(location_ids) for _ in range(lookups)]
+
+        mismatched = [location_id for location_id in set(sample)
+                      if legacy_lookup(cursor, location_id) !=
+                      document_lookup(cursor, location_id)]
+        if mismatched:
+            logging.warning('Lookups disagree for locations %s', sorted(mismatched))
+
+        results = {}
+        for name, lookup in (('legacy', legacy_lookup), ('document', document_lookup)):
+            time_lookups(cursor, lookup, sample[:min(100, lookups)])  # warm up
+            results[name] = summarize(time_lookups(cursor, lookup, sample))
+            logging.info('%s: mean %.3fms, p50 %.3fms, p99 %.3fms', name,
+                         results[name]['mean_ms'], results[name]['p50_ms'],
+                         results[name]['p99_ms'])
+    finally:
+        connection.rollback()
+        connection.close()
+
+    logging.info('Single-query lookups are %.1fx faster at the median',
+                 results['legacy']['p50_ms'] / results['document']['p50_ms'])
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--people', type=int, default=2000)
+    parser.add_argument('--locations', type=int, default=200)
+    parser.add_argument('--lookups', type=int, default=2000)
+    args = parser.parse_args()
+
+    benchmark(get_env_var('DATABASE_URL'), args.people, args.locations, args.lookups)
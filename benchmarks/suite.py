@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+
+'''
+Run the end-to-end benchmark suite.
+
+The suite creates a scratch database from schema.sql next to the one in
+DATABASE_URL, serves a synthetic directory from local stand-ins for the
+RC API and GeoNames, and then:
+
+  1. runs a full and an incremental update_data.py sync against them,
+     reporting records/second for each ingest phase, and
+  2. serves the app and sends scripted load to /api/locations/all,
+     /api/locations/<id> and /api/locations/search, reporting p50/p99
+     latency for each.
+
+Results are saved as JSON in the output directory, named by time and
+commit, and compared with the latest earlier run with the same settings.
+'''
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import make_dsn
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_upstreams import FakeUpstreams  # noqa: E402
+from benchmarks.synthetic import generate_directory  # noqa: E402
+
+
+def create_database(admin_url, name):
+    """Recreates database `name` on the server of `admin_url` from
+    schema.sql, and returns its connection string."""
+    connection = psycopg2.connect(admin_url)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute(f'DROP DATABASE IF EXISTS "{name}"')
+    cursor.execute(f'CREATE DATABASE "{name}"')
+    connection.close()
+
+    dsn = make_dsn(admin_url, dbname=name)
+    connection = psycopg2.connect(dsn)
+    with open(os.path.join(ROOT, 'schema.sql')) as schema:
+        connection.cursor().execute(schema.read())
+    connection.commit()
+    connection.close()
+    return dsn
+
+
+def drop_database(admin_url, name):
+    connection = psycopg2.connect(admin_url)
+    connection.autocommit = True
+    connection.cursor().execute(f'DROP DATABASE IF EXISTS "{name}"')
+    connection.close()
+
+
+def percentile(values, fraction):
+    "Returns the nearest-rank percentile of a list of numbers."
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def run_ingest(dsn, concurrency):
+    "Runs a full and then an incremental sync, and returns their phases."
+    import update_data
+
+    results = {}
+    for mode in ('full', 'incremental'):
+        pages = update_data.get_profile_pages(
+            update_data.rc_api_client('benchmark', concurrency), concurrency=concurrency)
+        phases = update_data.process_rc_data(dsn, pages, incremental=(mode == 'incremental'))
+        for phase, stats in phases.items():
+            if stats.get('records') and stats['seconds']:
+                stats['records_per_second'] = stats['records'] / stats['seconds']
+            if stats.get('rows') and stats['seconds']:
+                stats['rows_per_second'] = stats['rows'] / stats['seconds']
+            results[f'{mode}.{phase}'] = stats
+    return results
+
+
+def serve_app():
+    "Serves worldmap.app on a local port and returns (server, base URL)."
+    from werkzeug.serving import make_server
+    import worldmap
+
+    server = make_server('127.0.0.1', 0, worldmap.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True, name='app').start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def session_cookie():
+    "Returns a signed session cookie for a logged-in user."
+    import worldmap
+
+    serializer = worldmap.app.session_interface.get_signing_serializer(worldmap.app)
+    return {worldmap.app.config['SESSION_COOKIE_NAME']:
+            serializer.dumps({'recurse_user_id': 1})}
+
+
+def run_load(base_url, paths, concurrency, cookies):
+    "Requests every path with `concurrency` clients; returns a summary."
+    local = threading.local()
+
+    def fetch(path):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+            local.session.cookies.update(cookies)
+        start = time.perf_counter()
+        response = local.session.get(base_url + path)
+        return time.perf_counter() - start, response.status_code
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fetch, paths))
+    elapsed = time.perf_counter() - started
+
+    latencies = [latency for latency, _ in results]
+    return {
+        'requests': len(results),
+        'errors': sum(1 for _, status in results if status >= 400),
+        'requests_per_second': len(results) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': max(latencies) * 1000,
+    }
+
+
+def load_scenarios(locations, requests_per_endpoint, rng):
+    "Returns {endpoint: [paths]} of requests to send."
+    ids = [place['id'] for place in locations]
+    words = sorted({word.casefold() for place in locations
+                    for word in place['name'].replace(',', '').split()})
+    search = []
+    for _ in range(requests_per_endpoint):
+        if rng.random() < 0.1:
+            # Misses fall back to the (fake) RC API
+            search.append(f'/api/locations/search?query=zz{rng.randrange(10 ** 6)}')
+        else:
+            word = rng.choice(words)
+            search.append('/api/locations/search?query=' + word[:rng.randint(1, len(word))])
+
+    return {
+        '/api/locations/all': ['/api/locations/all'] * requests_per_endpoint,
+        '/api/locations/<id>': [f'/api/locations/{rng.choice(ids)}'
+                                for _ in range(requests_per_endpoint)],
+        '/api/locations/search': search,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return commit + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def save_results(results, output_dir):
+    "Saves results and returns the latest earlier results with the same settings."
+    os.makedirs(output_dir, exist_ok=True)
+    previous = None
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith('.json'):
+            with open(os.path.join(output_dir, name)) as f:
+                earlier = json.load(f)
+            if earlier.get('settings') == results['settings']:
+                previous = earlier
+
+    name = f"{results['started_at'].replace(':', '')}-{results['commit']}.json"
+    with open(os.path.join(output_dir, name), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    logging.info('Saved results to %s', os.path.join(output_dir, name))
+    return previous
+
+
+def change(current, previous):
+    if not previous:
+        return ''
+    return f' ({(current - previous) / previous * 100:+.0f}% vs {previous:.3g})'
+
+
+def report(results, previous):
+    previous = previous or {}
+    if previous:
+        logging.info('Comparing with %s from %s', previous['commit'], previous['started_at'])
+
+    for phase, stats in results['ingest'].items():
+        before = previous.get('ingest', {}).get(phase, {})
+        if 'records_per_second' in stats:
+            logging.info('ingest %-22s %8.0f records/s%s', phase, stats['records_per_second'],
+                         change(stats['records_per_second'], before.get('records_per_second')))
+        else:
+            logging.info('ingest %-22s %8.3fs%s', phase, stats['seconds'],
+                         change(stats['seconds'], before.get('seconds')))
+
+    for endpoint, stats in results['endpoints'].items():
+        before = previous.get('endpoints', {}).get(endpoint, {})
+        logging.info('%-22s p50 %7.2fms%s, p99 %7.2fms%s, %s errors', endpoint,
+                     stats['p50_ms'], change(stats['p50_ms'], before.get('p50_ms')),
+                     stats['p99_ms'], change(stats['p99_ms'], before.get('p99_ms')),
+                     stats['errors'])
+
+
+def main(args):
+    settings = {
+        'people': args.people,
+        'locations': args.locations,
+        'stints': args.stints,
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'latency': args.latency,
+        'seed': args.seed,
+    }
+    profiles, locations = generate_directory(args.people, args.locations, args.stints, args.seed)
+    upstreams = FakeUpstreams(profiles, locations, latency=args.latency).start()
+
+    admin_url = os.environ['DATABASE_URL']
+    dsn = create_database(admin_url, args.database)
+
+    # update_data and worldmap read their settings when they're imported
+    os.environ.update({
+        'DATABASE_URL': dsn,
+        'RC_API_URL': upstreams.rc_api_url,
+        'GEONAMES_URL': upstreams.geonames_url,
+        'GEONAMES_RATE': '10000',
+        'GEONAMES_BURST': '100',
+        'GEOCODER': 'geonames',
+    })
+    for name in ('GEONAMES_USERNAME', 'RC_API_ACCESS_TOKEN', 'CLIENT_ID', 'CLIENT_SECRET'):
+        os.environ.setdefault(name, 'benchmark')
+
+    results = {
+        'commit': git_commit(),
+        'started_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'settings': settings,
+    }
+    try:
+        results['ingest'] = run_ingest(dsn, args.concurrency)
+
+        server, base_url = serve_app()
+        cookies = session_cookie()
+        scenarios = load_scenarios(locations, args.requests, random.Random(args.seed))
+        results['endpoints'] = {}
+        for endpoint, paths in scenarios.items():
+            run_load(base_url, paths[:args.concurrency], args.concurrency, cookies)  # warm up
+            results['endpoints'][endpoint] = run_load(base_url, paths, args.concurrency, cookies)
+        server.shutdown()
+
+        import worldmap
+        worldmap.db_pool.closeall()
+    finally:
+        upstreams.stop()
+        if not args.keep_database:
+            drop_database(admin_url, args.database)
+
+    previous = save_results(results, args.output_dir)
+    report(results, previous)
+    return results
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--people', type=int, default=2000)
+    parser.add_argument('--locations', type=int, default=200)
+    parser.add_argument('--stints', type=int, default=2,
+                        help='average number of stints per person')
+    parser.add_argument('--requests', type=int, default=500,
+                        help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds each fake upstream response takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database', default='worldmap_benchmark',
+                        help='name of the scratch database to create')
+    parser.add_argument('--keep-database', action='store_true')
+    parser.add_argument('--output-dir', default=os.path.join(ROOT, 'benchmarks', 'results'))
+    main(parser.parse_args())
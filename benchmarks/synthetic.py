@@ -0,0 +1,116 @@
+"""
+Synthetic RC directory data for benchmarks
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from datetime import date, timedelta
+import random
+
+SEASONS = ['Winter', 'Spring', 'Summer', 'Fall']
+STINT_TYPES = ['retreat', 'retreat', 'retreat', 'employment', 'residency']
+
+
+def generate_batches(count):
+    """Returns RC API style batches, six per year starting in 2011. Names
+    are marked as synthetic so they can't clash with real batches."""
+    batches = []
+    for i in range(count):
+        year = 2011 + i // 6
+        season = SEASONS[(i % 6) * 4 // 6]
+        half = i % 2 + 1
+        batches.append({
+            'id': 90000 + i,
+            'name': f'{season} {half}, {year} (synthetic)',
+            'short_name': f"{season[0]}{half}'{year % 100:02}",
+            'start_date': date(year, 1, 1) + timedelta(days=61 * (i % 6)),
+        })
+    return batches
+
+
+def generate_locations(count, rng):
+    """Returns RC API style locations: one country for every ten cities,
+    with coordinates scattered over the inhabited latitudes."""
+    locations = []
+    countries = max(1, count // 11)
+    for i in range(count):
+        if i < countries:
+            name = f'Country {i}'
+        else:
+            name = f'City {i}, Country {i % countries}'
+        locations.append({
+            'id': 1000 + i,
+            'name': name,
+            'short_name': name.split(', ')[0],
+            'lat': round(rng.uniform(-45, 65), 5),
+            'lng': round(rng.uniform(-180, 180), 5),
+            'country_index': i % countries,
+        })
+    return locations
+
+
+def generate_profiles(people=1000, locations=100, stints=2, seed=0):
+    """Returns a list of RC API style profiles for `people` people spread
+    over `locations` locations, with about `stints` stints each."""
+    return generate_directory(people, locations, stints, seed)[0]
+
+
+def generate_directory(people=1000, locations=100, stints=2, seed=0):
+    """Returns (profiles, locations) for a synthetic RC directory of
+    `people` people spread over `locations` locations, with about
+    `stints` stints each.
+
+    Locations are picked with a long-tailed distribution, as in the real
+    directory, where a few cities hold most of the community."""
+    rng = random.Random(seed)
+    batches = generate_batches(60)
+    places = generate_locations(locations, rng)
+    weights = [1 / (i + 1) for i in range(len(places))]
+
+    profiles = []
+    for i in range(people):
+        location = rng.choices(places, weights)[0] if rng.random() < 0.9 else None
+        person_stints = []
+        start = batches[rng.randrange(len(batches))]['start_date']
+        for j in range(max(1, int(rng.gauss(stints, 0.5)))):
+            stint_type = rng.choice(STINT_TYPES)
+            batch = rng.choice(batches) if stint_type == 'retreat' else None
+            begin = start + timedelta(days=120 * j)
+            person_stints.append({
+                'type': stint_type,
+                'start_date': begin.isoformat(),
+                'end_date': (begin + timedelta(days=84)).isoformat(),
+                'title': None if stint_type == 'retreat' else 'Facilitator',
+                'batch': {
+                    'id': batch['id'],
+                    'name': batch['name'],
+                    'short_name': batch['short_name'],
+                } if batch else None,
+            })
+
+        profiles.append({
+            'id': i + 1,
+            'name': f'Recurser {i + 1}',
+            'image_path': f'https://example.com/{i + 1}.png',
+            'current_location': {
+                'id': location['id'],
+                'name': location['name'],
+                'short_name': location['short_name'],
+            } if location else None,
+            'stints': person_stints,
+        })
+
+    return profiles, places
@@ -0,0 +1,164 @@
+"""
+In-process caches for data that only changes when the dataset version does
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from collections import OrderedDict
+import gzip
+import hashlib
+import json
+import threading
+import time
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class VersionedCache:
+    """Holds one value per key, built on demand and rebuilt only when
+    the dataset version it was built from is out of date."""
+
+    def __init__(self):
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, version, build):
+        "Return the value for `key` at `version`, calling build() if needed."
+        entry = self._entries.get(key)
+        if entry and entry[0] == version:
+            return entry[1]
+
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+
+        # Only one thread rebuilds each key; the rest wait and reuse its
+        # result, while other keys are served or rebuilt alongside.
+        with key_lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == version:
+                return entry[1]
+
+            value = build()
+            self._entries[key] = (version, value)
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+
+class TTLCache:
+    """A bounded mapping whose entries expire `ttl` seconds after they are
+    stored. The least recently used entry is evicted when it is full."""
+
+    def __init__(self, maxsize=1024, ttl=3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Compression levels: brotli 11 and gzip 9 take seconds on a large
+# payload for a few percent smaller bodies
+COMPRESSION_LEVELS = {'gzip': 6, 'br': 5}
+
+# The entity tag suffix of each compressed variant
+ETAG_SUFFIXES = {'identity': '', 'gzip': '-gz', 'br': '-br'}
+
+
+class EncodedPayload:
+    """An encoded response body along with its gzip and brotli variants
+    and the entity tag for each of them.
+
+    Each variant is compressed the first time a response needs it, so
+    encodings no client asks for are never built."""
+
+    def __init__(self, body, mimetype='application/json'):
+        self.mimetype = mimetype
+        self.digest = hashlib.sha256(body).hexdigest()[:32]
+        self.encodings = ('br', 'gzip') if brotli else ('gzip',)
+        self.variants = {'identity': body}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_json(cls, data, mimetype='application/json'):
+        return cls(json.dumps(data, separators=(',', ':')).encode('utf-8'), mimetype)
+
+    def etag(self, encoding):
+        return self.digest + ETAG_SUFFIXES[encoding]
+
+    def variant(self, encoding):
+        "Returns the body for an encoding, compressing it if needed."
+        body = self.variants.get(encoding)
+        if body is None:
+            with self._lock:
+                body = self.variants.get(encoding)
+                if body is None:
+                    identity = self.variants['identity']
+                    if encoding == 'br':
+                        body = brotli.compress(identity, quality=COMPRESSION_LEVELS['br'])
+                    else:
+                        body = gzip.compress(identity, COMPRESSION_LEVELS['gzip'])
+                    self.variants[encoding] = body
+        return body
+
+    def negotiate(self, accept_encodings):
+        "Pick the smallest variant the client accepts."
+        for encoding in self.encodings:
+            if accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+    def response(self):
+        """Build a response for the current request, answering
+        304 Not Modified if the client already has this variant."""
+        encoding = self.negotiate(request.accept_encodings)
+        etag = self.etag(encoding)
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(self.variant(encoding), mimetype=self.mimetype)
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.vary.add('Accept-Encoding')
+        return response
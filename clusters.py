@@ -0,0 +1,165 @@
+"""
+Zoom-aware clustering of map locations
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, bisect_right
+import math
+
+# Matches the map's maxZoom, where the front end stops clustering markers
+MAX_ZOOM = 11
+
+# Grid cells span this many pixels on screen, a bit more than the
+# 42px maxClusterRadius used by the front end's marker cluster group
+CELL_SIZE_PX = 64
+TILE_SIZE_PX = 256
+
+# Web Mercator can't represent the poles
+MAX_LATITUDE = 85.05112878
+
+
+def project(lat, lng):
+    "Returns normalized Web Mercator coordinates in [0, 1) for lat/lng."
+    lat = max(-MAX_LATITUDE, min(MAX_LATITUDE, lat))
+    x = (lng + 180.0) / 360.0
+    sin_lat = math.sin(math.radians(lat))
+    y = 0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return min(max(x, 0.0), 1 - 1e-12), min(max(y, 0.0), 1 - 1e-12)
+
+
+class Cluster:
+    __slots__ = ('count', 'lat', 'lng', 'location_ids')
+
+    def __init__(self, count, lat, lng, location_ids):
+        self.count = count
+        self.lat = lat
+        self.lng = lng
+        self.location_ids = location_ids
+
+    @classmethod
+    def merge(cls, clusters):
+        "Combines clusters, weighting the centroid by each one's population."
+        count = sum(c.count for c in clusters)
+        weights = [max(c.count, 1) for c in clusters]
+        total = sum(weights)
+        lat = sum(c.lat * w for c, w in zip(clusters, weights)) / total
+        lng = sum(c.lng * w for c, w in zip(clusters, weights)) / total
+        location_ids = sorted(i for c in clusters for i in c.location_ids)
+        return cls(count, lat, lng, location_ids)
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'location_count': len(self.location_ids),
+            'lat': round(self.lat, 6),
+            'lng': round(self.lng, 6),
+            'location_ids': self.location_ids,
+        }
+
+
+class ClusterLevel:
+    "The clusters for one zoom level, sorted by longitude for range queries."
+
+    def __init__(self, clusters):
+        self.clusters = sorted(clusters, key=lambda c: c.lng)
+        self.lngs = [c.lng for c in self.clusters]
+
+    def _lng_range(self, west, east):
+        start = bisect_left(self.lngs, west)
+        end = bisect_right(self.lngs, east)
+        return self.clusters[start:end]
+
+    def within(self, west, south, east, north):
+        "Returns clusters with a centroid inside the bounding box."
+        if west <= east:
+            candidates = self._lng_range(west, east)
+        else:
+            # The box crosses the antimeridian
+            candidates = self._lng_range(west, 180.0) + \
+                self._lng_range(-180.0, east)
+
+        return [c for c in candidates if south <= c.lat <= north]
+
+
+class ClusterIndex:
+    """A pyramid of grid clusters, one level per zoom.
+
+    The finest level groups locations into grid cells CELL_SIZE_PX wide at
+    MAX_ZOOM - 1, and each coarser level merges the four cells beneath it,
+    so building costs O(locations * zoom levels) and a query only touches
+    the clusters near the requested bounding box."""
+
+    def __init__(self, locations):
+        """Builds the index from (location_id, lat, lng, population) tuples."""
+        # At MAX_ZOOM every location is its own marker
+        points = []
+        for location_id, lat, lng, population in locations:
+            cluster = Cluster(population, lat, lng, [location_id])
+            points.append((project(lat, lng), cluster))
+
+        self.levels = [None] * (MAX_ZOOM + 1)
+        self.levels[MAX_ZOOM] = ClusterLevel(c for _, c in points)
+
+        # Cells at zoom z are 2^(z + 2) to a side when CELL_SIZE_PX is 64
+        shift = int(math.log2(TILE_SIZE_PX // CELL_SIZE_PX))
+        scale = 1 << (MAX_ZOOM - 1 + shift)
+        cells = {}
+        for (x, y), cluster in points:
+            key = (int(x * scale), int(y * scale))
+            cells.setdefault(key, []).append(cluster)
+
+        for zoom in range(MAX_ZOOM - 1, -1, -1):
+            merged = {key: Cluster.merge(members)
+                      for key, members in cells.items()}
+            self.levels[zoom] = ClusterLevel(merged.values())
+
+            parents = {}
+            for (cx, cy), cluster in merged.items():
+                parents.setdefault((cx >> 1, cy >> 1), []).append(cluster)
+            cells = parents
+
+    def query(self, west, south, east, north, zoom):
+        "Returns the clusters for a bounding box at the given zoom level."
+        zoom = max(0, min(MAX_ZOOM, int(zoom)))
+        return self.levels[zoom].within(west, south, east, north)
+
+
+def wrap_longitude(lng):
+    "Maps a longitude from a panned map back into [-180, 180]."
+    if -180.0 <= lng <= 180.0:
+        return lng
+    return (lng + 180.0) % 360.0 - 180.0
+
+
+def parse_bbox(value):
+    """Parses a "west,south,east,north" string, as produced by Leaflet's
+    LatLngBounds.toBBoxString(). Raises ValueError if it is malformed."""
+    parts = [float(part) for part in value.split(',')]
+    if len(parts) != 4 or not all(math.isfinite(p) for p in parts):
+        raise ValueError(f"Expected west,south,east,north, got {value!r}")
+
+    west, south, east, north = parts
+    if south > north:
+        raise ValueError(f"South {south} is above north {north}")
+
+    # A box wider than the world covers every longitude
+    if east - west >= 360:
+        west, east = -180.0, 180.0
+    else:
+        west, east = wrap_longitude(west), wrap_longitude(east)
+
+    return west, south, east, north
@@ -0,0 +1,114 @@
+"""
+Compact columnar encoding of the /api/locations/all payload
+
+Instead of a list of objects that repeat every key, each list of records
+becomes a table with one column per field:
+
+    {"format": "columnar", "version": 1,
+     "strings": ["city", "retreat", "W1'19", ...],
+     "table": {"length": 2, "columns": {
+         "location_id": [10, 11],
+         "type": {"interned": [0, 0]},
+         "has_rc_people": {"constant": true},
+         "person_list": {"nested": {"counts": [3, 1], "table": {...}}}}}}
+
+Values that repeat across thousands of stints, such as batch names and
+stint types, are stored once in the shared string table and referred to
+by index; columns holding the same value on every row are stored once;
+and nested lists are flattened into a child table plus a count per row.
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+FORMAT_VERSION = 1
+
+JSON_MIMETYPE = 'application/vnd.worldmap.columnar+json'
+MSGPACK_MIMETYPE = 'application/vnd.worldmap.columnar+msgpack'
+
+# Fields whose values are shared by many records
+INTERNED_FIELDS = {'type', 'stint_type', 'rc_title', 'batch_name', 'start_date'}
+
+# Fields holding lists of records
+NESTED_FIELDS = {'person_list', 'stints'}
+
+
+def encode(records):
+    "Returns the columnar form of a list of records."
+    strings = {}
+    table = encode_table(records, strings)
+    return {
+        'format': 'columnar',
+        'version': FORMAT_VERSION,
+        'strings': list(strings),
+        'table': table,
+    }
+
+
+def decode(payload):
+    "Returns the list of records a columnar payload was encoded from."
+    if payload.get('format') != 'columnar' or payload.get('version') != FORMAT_VERSION:
+        raise ValueError('Not a version %s columnar payload' % FORMAT_VERSION)
+    return decode_table(payload['table'], payload['strings'])
+
+
+def encode_table(records, strings):
+    """Returns {length, columns} for a list of records. `strings` maps each
+    interned value to its index, and is added to as values are found."""
+    fields = {}
+    for record in records:
+        fields.update(dict.fromkeys(record))
+
+    columns = {}
+    for field in fields:
+        values = [record[field] for record in records]
+        if field in NESTED_FIELDS:
+            children = [child for value in values for child in value]
+            columns[field] = {'nested': {
+                'counts': [len(value) for value in values],
+                'table': encode_table(children, strings),
+            }}
+        elif len(values) > 1 and all(value == values[0] for value in values):
+            columns[field] = {'constant': values[0]}
+        elif field in INTERNED_FIELDS:
+            columns[field] = {'interned': [strings.setdefault(value, len(strings))
+                                           for value in values]}
+        else:
+            columns[field] = values
+
+    return {'length': len(records), 'columns': columns}
+
+
+def decode_table(table, strings):
+    length = table['length']
+    columns = {}
+    for field, column in table['columns'].items():
+        if isinstance(column, list):
+            columns[field] = column
+        elif 'constant' in column:
+            columns[field] = [column['constant']] * length
+        elif 'interned' in column:
+            columns[field] = [strings[index] for index in column['interned']]
+        else:
+            children = decode_table(column['nested']['table'], strings)
+            values = []
+            start = 0
+            for count in column['nested']['counts']:
+                values.append(children[start:start + count])
+                start += count
+            columns[field] = values
+
+    return [{field: values[i] for field, values in columns.items()}
+            for i in range(length)]
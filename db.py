@@ -0,0 +1,199 @@
+"""
+Pooled PostgreSQL connections for the Recurse World Map back-end
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from contextlib import contextmanager
+import logging
+import os
+import threading
+import time
+import weakref
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+
+class PoolTimeout(psycopg2.pool.PoolError):
+    "Raised when no connection becomes available before the checkout timeout."
+
+
+class ConnectionPool:
+    """A thread-safe pool of psycopg2 connections.
+
+    Connections are created lazily in the process that uses them, so a pool
+    built at import time in the gunicorn master is safe to use after the
+    workers fork: a forked child forgets any connections inherited from
+    its parent without closing them.
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=30.0,
+                 validate_after=5.0, connect=psycopg2.connect, **connect_kwargs):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(
+                f"Invalid pool size: min_size={min_size}, max_size={max_size}")
+
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.validate_after = validate_after
+        self._connect = connect
+        self._connect_kwargs = connect_kwargs
+
+        self._reset()
+
+        ref = weakref.ref(self)
+        os.register_at_fork(
+            after_in_child=lambda: ref() and ref()._reset())
+
+    def _reset(self):
+        """Start over with an empty pool.
+
+        Sockets shared with a parent process must not be closed from the
+        child, otherwise the parent's session is torn down as well, so
+        inherited connections are simply forgotten."""
+        self._lock = threading.Condition()
+        self._idle = []   # (connection, last_used) pairs, most recent last
+        self._in_use = 0
+        self._filled = False
+
+    def _new_connection(self):
+        return self._connect(self.dsn, **self._connect_kwargs)
+
+    def _fill(self):
+        "Open connections until min_size are available."
+        with self._lock:
+            if self._filled:
+                return
+            self._filled = True
+            missing = max(self.min_size - len(self._idle) - self._in_use, 0)
+            self._in_use += missing
+
+        opened = []
+        try:
+            for _ in range(missing):
+                opened.append(self._new_connection())
+        finally:
+            with self._lock:
+                self._in_use -= missing
+                now = time.monotonic()
+                self._idle.extend((conn, now) for conn in opened)
+                self._lock.notify(len(opened))
+
+    def _is_usable(self, conn, last_used):
+        "Validate an idle connection before handing it out."
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.validate_after:
+            return True
+
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            logging.warning('Discarding broken pooled connection')
+            return False
+
+    def getconn(self):
+        "Check out a connection, waiting up to `timeout` seconds for one."
+        if not self._filled:
+            self._fill()
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._lock:
+                while not self._idle and self._in_use >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(
+                            f"No database connection available after {self.timeout}s")
+                    self._lock.wait(remaining)
+
+                self._in_use += 1
+                idle = self._idle.pop() if self._idle else None
+
+            try:
+                if idle is None:
+                    return self._new_connection()
+                if self._is_usable(*idle):
+                    return idle[0]
+                self._close_quietly(idle[0])
+            except BaseException:
+                self._release_slot()
+                raise
+            # A stale connection was dropped; give its slot back and retry.
+            self._release_slot()
+
+    def putconn(self, conn, discard=False):
+        "Return a connection to the pool, or drop it if it is unusable."
+        if not discard and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+
+        if discard or conn.closed:
+            self._close_quietly(conn)
+            self._release_slot()
+            return
+
+        with self._lock:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._lock.notify()
+
+    def _release_slot(self):
+        with self._lock:
+            self._in_use -= 1
+            self._lock.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a `with` block.
+
+        Any open transaction is rolled back when the block exits, so callers
+        must commit their own writes. Connections that fail with an
+        OperationalError or InterfaceError are closed instead of being
+        returned, and the next checkout opens a fresh one."""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def closeall(self):
+        "Close every idle connection owned by this process."
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for conn, _ in idle:
+            self._close_quietly(conn)
@@ -0,0 +1,55 @@
+"""
+Gunicorn settings for serving the Recurse World Map
+
+By default each worker process is a gevent worker: requests run as
+greenlets, and a request waiting on the RC API, GeoNames or Postgres
+yields to the others instead of holding up the whole process. Set
+GUNICORN_WORKER_CLASS=sync to serve one request per process at a time.
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import glob
+import os
+import tempfile
+from dotenv import load_dotenv
+
+load_dotenv()
+
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gevent')
+workers = int(os.environ.get('WEB_CONCURRENCY', '2'))
+# Concurrent requests per gevent worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+# Each worker saves its metrics here, so that a scrape of any one of them
+# reports the totals of all of them (see metrics.Registry.share)
+metrics_dir = os.environ.setdefault(
+    'METRICS_DIR', os.path.join(tempfile.gettempdir(), 'worldmap-metrics'))
+
+
+def on_starting(server):
+    "Clears the metrics the workers of a previous run left behind."
+    for path in glob.glob(os.path.join(metrics_dir, '*.json')):
+        os.remove(path)
+
+
+def post_fork(server, worker):
+    """Makes psycopg2 wait for Postgres cooperatively in gevent workers.
+    This has to happen before the app opens its first connection."""
+    if worker_class == 'gevent':
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+        server.log.info('Worker %s: psycopg2 patched for gevent', worker.pid)
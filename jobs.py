@@ -0,0 +1,43 @@
+"""
+Background jobs for work too slow to do inside a web request
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+
+class BackgroundJobs:
+    """Runs jobs on a small, bounded pool of background threads. Callers
+    decide whether a job should run at all; for geocoding, only the
+    worker that claims a location in the database submits its job."""
+
+    def __init__(self, max_workers=2, name='jobs'):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix=name)
+
+    def submit(self, key, fn, *args, **kwargs):
+        "Returns a Future for fn(*args), logging any exception it raises."
+        return self._executor.submit(self._run, key, fn, *args, **kwargs)
+
+    @staticmethod
+    def _run(key, fn, *args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            logging.exception('Background job %s failed', key)
+            raise
@@ -0,0 +1,295 @@
+"""
+Request, query and upstream timings, exposed in the Prometheus text format
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+import atexit
+import glob
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import psycopg2.extensions
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds in seconds, from a fast indexed query to a slow upstream call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Counts observations into buckets, per tuple of label values.
+
+    Observing only finds the bucket and adds to it; nothing is formatted
+    until the metrics are scraped."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # labels -> [count per bucket..., count above, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def state(self):
+        "Returns a copy of the counts, by tuple of label values."
+        with self._lock:
+            return {labels: list(values) for labels, values in self._series.items()}
+
+    @staticmethod
+    def merge(total, values):
+        "Adds the counts of another process to `total`."
+        return [a + b for a, b in zip(total, values)] if total else values
+
+    def samples(self, series=None):
+        if series is None:
+            series = self.state()
+
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), values):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield (self.name + '_bucket',
+                       format_labels(self.labelnames, labels, f'le="{le}"'), cumulative)
+            yield self.name + '_sum', format_labels(self.labelnames, labels), values[-1]
+            yield self.name + '_count', format_labels(self.labelnames, labels), cumulative
+
+
+class Counter:
+    "A running total per tuple of label values."
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def state(self):
+        "Returns a copy of the totals, by tuple of label values."
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(total, value):
+        "Adds the total of another process to `total`."
+        return (total or 0) + value
+
+    def samples(self, values=None):
+        if values is None:
+            values = self.state()
+        for labels, value in sorted(values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    """Values read when the metrics are scraped: `collect` returns a dict
+    of {tuple of label values: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Registry:
+    """The metrics served at /metrics.
+
+    Counters and histograms belong to the process that records them. With
+    several worker processes, call share() in each one: every process then
+    saves its own values to a file in a shared directory, and render()
+    adds up the files, so whichever worker is scraped reports the totals
+    of all of them, including workers that have since exited."""
+
+    def __init__(self):
+        self._metrics = []
+        self.directory = None
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def share(self, directory, interval=5.0):
+        """Saves this process's values in `directory` every `interval`
+        seconds and when it exits, and renders the totals of every
+        process that has saved values there."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        atexit.register(self.save)
+        threading.Thread(target=self._save_every, args=(interval,),
+                         name='metrics', daemon=True).start()
+
+    def _save_every(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning('Could not save metrics: %s', e)
+
+    def save(self):
+        "Writes this process's counters and histograms to its shared file."
+        state = {metric.name: [[list(labels), values]
+                               for labels, values in metric.state().items()]
+                 for metric in self._metrics if hasattr(metric, 'state')}
+        path = os.path.join(self.directory, f'{os.getpid()}.json')
+        # Write the whole file before renaming it into place, so other
+        # processes never read half of it
+        with open(path + '.tmp', 'w', encoding='utf-8') as shared_file:
+            json.dump(state, shared_file)
+        os.replace(path + '.tmp', path)
+
+    def load_shared(self):
+        "Returns the totals of every process, by metric name."
+        self.save()
+        shared = {metric.name: metric for metric in self._metrics
+                  if hasattr(metric, 'state')}
+        totals = {name: {} for name in shared}
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                with open(path, encoding='utf-8') as shared_file:
+                    state = json.load(shared_file)
+            except (OSError, ValueError) as e:
+                logging.warning('Skipping metrics file %s: %s', path, e)
+                continue
+            for name, series in state.items():
+                if name not in shared:
+                    continue
+                for labels, values in series:
+                    labels = tuple(labels)
+                    totals[name][labels] = shared[name].merge(totals[name].get(labels), values)
+        return totals
+
+    def render(self):
+        "Returns every metric in the Prometheus text exposition format."
+        shared = self.load_shared() if self.directory else {}
+        lines = []
+        for metric in self._metrics:
+            lines.append(f'# HELP {metric.name} {escape(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            samples = metric.samples(shared[metric.name]) if metric.name in shared \
+                else metric.samples()
+            lines.extend(f'{name}{labels} {format_value(value)}'
+                         for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_request_seconds = registry.histogram(
+    'worldmap_http_request_seconds', 'Time spent handling requests, by route.',
+    ('route', 'method', 'status'))
+db_query_seconds = registry.histogram(
+    'worldmap_db_query_seconds', 'Time spent running SQL statements, by calling function.',
+    ('caller',))
+upstream_request_seconds = registry.histogram(
+    'worldmap_upstream_request_seconds',
+    'Time spent on each request to the RC API and GeoNames, by response status.',
+    ('upstream', 'status'))
+upstream_retries = registry.counter(
+    'worldmap_upstream_retries_total',
+    'Requests to the RC API and GeoNames retried after a failed attempt.',
+    ('upstream',))
+upstream_rejected = registry.counter(
+    'worldmap_upstream_rejected_total',
+    'Requests not sent because the upstream circuit breaker was open.',
+    ('upstream',))
+
+
+def query_caller():
+    """Returns the name of the function that ran the current statement,
+    skipping psycopg2 helpers such as execute_values."""
+    frame = sys._getframe(2)  # pylint: disable=protected-access
+    while frame is not None and frame.f_globals.get('__name__', '').startswith('psycopg2'):
+        frame = frame.f_back
+    return frame.f_code.co_name if frame is not None else 'unknown'
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """A cursor that records how long each statement takes in
+    worldmap_db_query_seconds. Pass it to psycopg2.connect() as the
+    cursor_factory."""
+
+    # pylint: disable=redefined-builtin
+    def execute(self, query, vars=None):
+        caller = query_caller()
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            db_query_seconds.observe((caller,), time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        caller = query_caller()
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            db_query_seconds.observe((caller,), time.perf_counter() - start)
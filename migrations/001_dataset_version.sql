@@ -0,0 +1,7 @@
+CREATE TABLE IF NOT EXISTS dataset_version (
+  singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+INSERT INTO dataset_version DEFAULT VALUES ON CONFLICT DO NOTHING;
@@ -0,0 +1,47 @@
+DROP VIEW IF EXISTS geolocations_people_and_stints_agg;
+DROP VIEW IF EXISTS geolocations_popl_by_country_agg;
+
+-- The aggregates below are materialized and only change when
+-- update_data.refresh_aggregates() runs after new data is written.
+CREATE MATERIALIZED VIEW geolocations_popl_by_country_agg AS
+SELECT 
+  location_id,
+  country_name,
+  COUNT(sub_id) FILTER (WHERE sub_type = 'city') AS city_count,
+  SUM(population::INTEGER) AS total_population
+FROM geolocations_popl_by_country
+GROUP BY location_id, country_name
+ORDER BY location_id;
+
+CREATE UNIQUE INDEX geolocations_popl_by_country_agg_location_id
+  ON geolocations_popl_by_country_agg (location_id);
+
+CREATE MATERIALIZED VIEW geolocations_people_and_stints_agg AS
+SELECT
+  g.location_id,
+  g.location_name,
+  g.type,
+  g.lat,
+  g.lng,
+  COALESCE(p.city_count, 0) AS city_count,
+  COALESCE(p.total_population, 0) AS total_population,
+  json_agg(
+      json_build_object(
+          'person_id', g.person_id, 
+          'name', person_name, 
+          'image_url', image_url,
+          'stints', stints
+      )
+      ORDER BY person_name
+  ) AS person_list
+FROM geolocations_with_affiliated_people AS g
+INNER JOIN stints_for_people_agg AS s
+  ON s.person_id = g.person_id
+LEFT JOIN geolocations_popl_by_country_agg p 
+  ON p.location_id = g.location_id
+GROUP BY g.location_id, g.location_name, g.type, g.lat, g.lng,
+  p.city_count, p.total_population
+ORDER BY g.location_id;
+
+CREATE UNIQUE INDEX geolocations_people_and_stints_agg_location_id
+  ON geolocations_people_and_stints_agg (location_id);
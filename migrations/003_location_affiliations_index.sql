@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS location_affiliations_location_id
+  ON location_affiliations (location_id);
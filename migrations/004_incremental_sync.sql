@@ -0,0 +1,15 @@
+CREATE TABLE IF NOT EXISTS person_fingerprints (
+  person_id INTEGER NOT NULL REFERENCES people (person_id) PRIMARY KEY,
+  fingerprint TEXT NOT NULL,
+  synced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS sync_runs (
+  run_id SERIAL PRIMARY KEY,
+  mode TEXT NOT NULL,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ NULL,
+  people_seen INTEGER NOT NULL DEFAULT 0,
+  people_changed INTEGER NOT NULL DEFAULT 0,
+  rows_touched INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,8 @@
+CREATE TABLE IF NOT EXISTS geocode_cache (
+  query TEXT NOT NULL,
+  feature_classes TEXT NOT NULL,
+  max_rows INTEGER NOT NULL,
+  result JSONB NOT NULL,
+  fetched_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (query, feature_classes, max_rows)
+);
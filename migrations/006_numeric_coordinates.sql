@@ -0,0 +1,103 @@
+-- Coordinates become numbers, with an indexed grid cell key for
+-- proximity lookups. The views that read lat/lng are recreated around
+-- the column type change.
+DROP MATERIALIZED VIEW IF EXISTS geolocations_people_and_stints_agg;
+DROP MATERIALIZED VIEW IF EXISTS geolocations_popl_by_country_agg;
+DROP VIEW IF EXISTS geolocations_popl_by_country;
+DROP VIEW IF EXISTS geolocations_with_affiliated_people;
+
+CREATE OR REPLACE FUNCTION geo_grid_cell(lat DOUBLE PRECISION, lng DOUBLE PRECISION)
+RETURNS BIGINT
+LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+AS $$
+  SELECT floor((lat + 90) * 100)::BIGINT * 100000 + floor((lng + 180) * 100)::BIGINT
+$$;
+
+ALTER TABLE geolocations
+  ALTER COLUMN lat TYPE DOUBLE PRECISION USING lat::DOUBLE PRECISION,
+  ALTER COLUMN lng TYPE DOUBLE PRECISION USING lng::DOUBLE PRECISION;
+
+ALTER TABLE geolocations
+  ADD COLUMN grid_cell BIGINT GENERATED ALWAYS AS (geo_grid_cell(lat, lng)) STORED;
+
+CREATE INDEX IF NOT EXISTS geolocations_grid_cell
+  ON geolocations (grid_cell);
+
+CREATE VIEW geolocations_with_affiliated_people AS
+SELECT
+  l.location_id,
+  l.name AS location_name,
+  l.lat,
+  l.lng,
+  l.country_code,
+  l.type,
+  p.person_id,
+  p.name AS person_name,
+  p.image_url
+FROM geolocations l
+INNER JOIN location_affiliations a
+  ON (a.location_id = l.location_id)
+INNER JOIN people p
+  ON a.person_id = p.person_id
+ORDER BY l.location_id;
+
+CREATE VIEW geolocations_popl_by_country AS
+SELECT DISTINCT
+  a.location_id,
+  a.name AS country_name,
+  b.location_id AS sub_id, 
+  b.type AS sub_type,
+  b.location_name AS sub_name, 
+  COUNT(b.person_id) AS population
+FROM geolocations a
+INNER JOIN geolocations_with_affiliated_people b
+  ON a.country_code = b.country_code
+WHERE a.type = 'country' 
+GROUP BY a.location_id, a.name,
+  b.location_id, b.type, b.location_name
+ORDER BY a.location_id;
+
+-- The aggregates below are materialized and only change when
+-- update_data.refresh_aggregates() runs after new data is written.
+CREATE MATERIALIZED VIEW geolocations_popl_by_country_agg AS
+SELECT 
+  location_id,
+  country_name,
+  COUNT(sub_id) FILTER (WHERE sub_type = 'city') AS city_count,
+  SUM(population::INTEGER) AS total_population
+FROM geolocations_popl_by_country
+GROUP BY location_id, country_name
+ORDER BY location_id;
+
+CREATE UNIQUE INDEX geolocations_popl_by_country_agg_location_id
+  ON geolocations_popl_by_country_agg (location_id);
+
+CREATE MATERIALIZED VIEW geolocations_people_and_stints_agg AS
+SELECT
+  g.location_id,
+  g.location_name,
+  g.type,
+  g.lat,
+  g.lng,
+  COALESCE(p.city_count, 0) AS city_count,
+  COALESCE(p.total_population, 0) AS total_population,
+  json_agg(
+      json_build_object(
+          'person_id', g.person_id, 
+          'name', person_name, 
+          'image_url', image_url,
+          'stints', stints
+      )
+      ORDER BY person_name
+  ) AS person_list
+FROM geolocations_with_affiliated_people AS g
+INNER JOIN stints_for_people_agg AS s
+  ON s.person_id = g.person_id
+LEFT JOIN geolocations_popl_by_country_agg p 
+  ON p.location_id = g.location_id
+GROUP BY g.location_id, g.location_name, g.type, g.lat, g.lng,
+  p.city_count, p.total_population
+ORDER BY g.location_id;
+
+CREATE UNIQUE INDEX geolocations_people_and_stints_agg_location_id
+  ON geolocations_people_and_stints_agg (location_id);
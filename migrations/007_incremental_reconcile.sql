@@ -0,0 +1,8 @@
+-- Existing geolocations start out unreconciled,
+-- so the next update checks all of them once
+ALTER TABLE geolocations
+  ADD COLUMN IF NOT EXISTS reconciled BOOLEAN NOT NULL DEFAULT FALSE;
+
+-- Geolocations not yet checked for duplicates by reconcile_duplicates()
+CREATE INDEX IF NOT EXISTS geolocations_unreconciled
+  ON geolocations (location_id) WHERE NOT reconciled;
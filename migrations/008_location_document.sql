@@ -0,0 +1,55 @@
+-- Resolves a whole /api/locations/<id> response in one query
+
+-- Returns everything /api/locations/<id> serves for a location, as one
+-- JSON document: its alias is resolved, and it has its people if it has
+-- any, or else its geolocation and, for a country, its population.
+-- Returns NULL if the location hasn't been geocoded yet. PL/pgSQL keeps
+-- the plans of these statements for the session, so calls skip planning.
+CREATE OR REPLACE FUNCTION location_document(requested_id INTEGER)
+RETURNS JSON
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+  resolved_id INTEGER;
+  document JSON;
+BEGIN
+  SELECT preferred_location_id INTO resolved_id
+  FROM location_aliases
+  WHERE location_id = requested_id;
+  resolved_id := COALESCE(resolved_id, requested_id);
+
+  SELECT json_build_object(
+      'location_id', p.location_id,
+      'location_name', p.location_name,
+      'type', p.type,
+      'lat', p.lat,
+      'lng', p.lng,
+      'city_count', p.city_count,
+      'total_population', p.total_population,
+      'has_rc_people', TRUE,
+      'person_list', p.person_list
+    ) INTO document
+  FROM geolocations_people_and_stints_agg p
+  WHERE p.location_id = resolved_id;
+  IF FOUND THEN
+    RETURN document;
+  END IF;
+
+  SELECT json_strip_nulls(json_build_object(
+      'location_id', g.location_id,
+      'location_name', g.name,
+      'type', g.type,
+      'lat', g.lat,
+      'lng', g.lng,
+      'has_rc_people', FALSE,
+      'city_count', c.city_count,
+      'total_population', c.total_population
+    )) INTO document
+  FROM geolocations g
+  LEFT JOIN geolocations_popl_by_country_agg c
+    ON c.location_id = g.location_id
+    AND g.type <> 'city'
+  WHERE g.location_id = resolved_id;
+  RETURN document;
+END
+$$;
@@ -0,0 +1,3 @@
+-- How long each phase of an update took, served at /metrics
+ALTER TABLE sync_runs
+  ADD COLUMN IF NOT EXISTS phases JSONB NULL;
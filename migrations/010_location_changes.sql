@@ -0,0 +1,17 @@
+ALTER TABLE dataset_version
+  ADD COLUMN IF NOT EXISTS compacted_through BIGINT NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS location_fingerprints (
+  location_id INTEGER PRIMARY KEY,
+  fingerprint TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS location_changes (
+  version BIGINT NOT NULL,
+  location_id INTEGER NOT NULL,
+  PRIMARY KEY (version, location_id)
+);
+
+-- With no fingerprints yet, the next version records every location as
+-- changed, so clients on the current version or older reload in full
+UPDATE dataset_version SET compacted_through = version + 1;
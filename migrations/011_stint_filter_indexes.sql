@@ -0,0 +1,5 @@
+CREATE INDEX IF NOT EXISTS stints_batch_id
+  ON stints (batch_id);
+
+CREATE INDEX IF NOT EXISTS stints_stint_type_start_date
+  ON stints (stint_type, start_date);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS geocode_jobs (
+  location_id INTEGER NOT NULL PRIMARY KEY,
+  status TEXT NOT NULL,
+  error TEXT,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,34 @@
+-- People with the same name are listed in person_id order, so that
+-- person_list, and the fingerprint of each location computed from it,
+-- only change when the people do.
+DROP MATERIALIZED VIEW IF EXISTS geolocations_people_and_stints_agg;
+
+CREATE MATERIALIZED VIEW geolocations_people_and_stints_agg AS
+SELECT
+  g.location_id,
+  g.location_name,
+  g.type,
+  g.lat,
+  g.lng,
+  COALESCE(p.city_count, 0) AS city_count,
+  COALESCE(p.total_population, 0) AS total_population,
+  json_agg(
+      json_build_object(
+          'person_id', g.person_id, 
+          'name', person_name, 
+          'image_url', image_url,
+          'stints', stints
+      )
+      ORDER BY person_name, g.person_id
+  ) AS person_list
+FROM geolocations_with_affiliated_people AS g
+INNER JOIN stints_for_people_agg AS s
+  ON s.person_id = g.person_id
+LEFT JOIN geolocations_popl_by_country_agg p 
+  ON p.location_id = g.location_id
+GROUP BY g.location_id, g.location_name, g.type, g.lat, g.lng,
+  p.city_count, p.total_population
+ORDER BY g.location_id;
+
+CREATE UNIQUE INDEX geolocations_people_and_stints_agg_location_id
+  ON geolocations_people_and_stints_agg (location_id);
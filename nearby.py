@@ -0,0 +1,136 @@
+"""
+In-memory spatial index for "RCers within N km" queries
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import heapq
+import math
+
+# Mean radius of the Earth
+EARTH_RADIUS_KM = 6371.0088
+
+# Half the Earth's circumference, the furthest two points can be apart
+MAX_DISTANCE_KM = math.pi * EARTH_RADIUS_KM
+
+
+def to_unit_vector(lat, lng):
+    "Returns the point on the unit sphere for a latitude and longitude."
+    lat, lng = math.radians(lat), math.radians(lng)
+    cos_lat = math.cos(lat)
+    return (cos_lat * math.cos(lng), cos_lat * math.sin(lng), math.sin(lat))
+
+
+def km_to_chord(distance_km):
+    "Returns the straight-line distance through the unit sphere for a surface distance."
+    return 2 * math.sin(min(distance_km, MAX_DISTANCE_KM) / EARTH_RADIUS_KM / 2)
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+def squared_distance(a, b):
+    return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+
+class SpatialIndex:
+    """A k-d tree of locations, answering which ones are within a radius
+    of a point and which are the k nearest to it.
+
+    Locations are stored as points on the unit sphere. The straight-line
+    distance between two of them grows with their great-circle distance,
+    so an ordinary Euclidean k-d tree finds the same neighbours as the
+    haversine formula would, with no special cases at the poles or the
+    antimeridian. Queries only visit the branches that could hold a
+    match, about O(log n) nodes for small radii."""
+
+    def __init__(self, locations):
+        "Builds the index from (location_id, lat, lng) tuples."
+        points = [(to_unit_vector(lat, lng), location_id)
+                  for location_id, lat, lng in locations]
+        self.size = len(points)
+        self._root = self._build(points, 0)
+
+    def _build(self, points, depth):
+        """Returns a (point, location_id, axis, left, right) node splitting
+        the points at the median of one coordinate, or None if empty."""
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda p: p[0][axis])
+        median = len(points) // 2
+        point, location_id = points[median]
+        return (point, location_id, axis,
+                self._build(points[:median], depth + 1),
+                self._build(points[median + 1:], depth + 1))
+
+    def within(self, lat, lng, radius_km):
+        """Returns (distance in km, location_id) for every location within
+        radius_km of a point, nearest first."""
+        target = to_unit_vector(lat, lng)
+        limit = km_to_chord(radius_km) ** 2
+
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node is None:
+                continue
+            point, location_id, axis, left, right = node
+            distance = squared_distance(point, target)
+            if distance <= limit:
+                found.append((distance, location_id))
+
+            offset = target[axis] - point[axis]
+            stack.append(left if offset < 0 else right)
+            # The other side can only hold matches if the splitting plane
+            # itself is within the radius
+            if offset * offset <= limit:
+                stack.append(right if offset < 0 else left)
+
+        found.sort()
+        return [(chord_to_km(math.sqrt(d)), location_id) for d, location_id in found]
+
+    def nearest(self, lat, lng, k, radius_km=MAX_DISTANCE_KM):
+        """Returns (distance in km, location_id) for the k locations nearest
+        to a point and within radius_km of it, nearest first."""
+        if k <= 0:
+            return []
+        target = to_unit_vector(lat, lng)
+        limit = km_to_chord(radius_km) ** 2
+        best = []   # max-heap of the k nearest so far, as (-distance, -id)
+
+        def visit(node):
+            if node is None:
+                return
+            point, location_id, axis, left, right = node
+            distance = squared_distance(point, target)
+            if distance <= limit:
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, -location_id))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, -location_id))
+
+            offset = target[axis] - point[axis]
+            visit(left if offset < 0 else right)
+            worst = -best[0][0] if len(best) == k else limit
+            if offset * offset <= worst:
+                visit(right if offset < 0 else left)
+
+        visit(self._root)
+        return [(chord_to_km(math.sqrt(-d)), -negative_id)
+                for d, negative_id in sorted(best, reverse=True)]
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+'''
+Geocode locations offline from a GeoNames dump.
+
+The "build" command turns GeoNames dump files (such as cities500.txt, from
+https://download.geonames.org/export/dump/) and countryInfo.txt into a
+compact index file. update_data.py memory-maps that file when GEOCODER is
+set to "offline", and resolves locations from it in place of the GeoNames
+web service, falling back to the web service for anything it can't find.
+
+Countries are only resolved offline if the dump files include their
+country features (feature codes PCL*), as allCountries.txt does.
+'''
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import logging
+import mmap
+import struct
+import unicodedata
+
+MAGIC = b'WMGEO\x00\x01\x00'
+
+# magic, record count, entry count, strings size, countries size
+HEADER = struct.Struct('<8sIIII')
+# lat, lng, population, feature class, country code, admin1 code
+RECORD = struct.Struct('<ddqc2s20s')
+# key offset and length in the string table, record number
+ENTRY = struct.Struct('<III')
+
+# Columns of the GeoNames "geoname" dump format
+NAME, ASCII_NAME, LATITUDE, LONGITUDE = 1, 2, 4, 5
+FEATURE_CLASS, FEATURE_CODE, COUNTRY_CODE, ADMIN1_CODE, POPULATION = 6, 7, 8, 10, 14
+
+
+def normalize_name(name):
+    "Returns a lookup key for a place name: lowercase, without accents."
+    decomposed = unicodedata.normalize('NFKD', name or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return ' '.join(stripped.casefold().split())
+
+
+def read_country_info(path):
+    "Returns {normalized country name: ISO code} from countryInfo.txt."
+    countries = {}
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('#') or not line.strip():
+                continue
+            columns = line.rstrip('\n').split('\t')
+            countries[normalize_name(columns[4])] = columns[0]
+    return countries
+
+
+def read_dump(path):
+    "Yields the columns of each place in a GeoNames dump file."
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            columns = line.rstrip('\n').split('\t')
+            if len(columns) >= 15 and columns[FEATURE_CLASS] in ('A', 'P'):
+                yield columns
+
+
+def build_index(dump_paths, country_info_path, output_path):
+    """Writes an index of the populated places and countries in the dumps.
+
+    The file holds a header, a fixed-width record per place, a table of
+    (name, record) entries sorted by normalized name, the names themselves,
+    and a small JSON table of countries."""
+    country_codes = read_country_info(country_info_path)
+    country_places = {}
+
+    records = []
+    entries = []
+    for path in dump_paths:
+        for columns in read_dump(path):
+            population = int(columns[POPULATION] or 0)
+            country = columns[COUNTRY_CODE]
+
+            if columns[FEATURE_CODE].startswith('PCL'):
+                best = country_places.get(country)
+                if best is None or population > best[2]:
+                    country_places[country] = (
+                        columns[LATITUDE], columns[LONGITUDE], population)
+                continue
+            if columns[FEATURE_CLASS] != 'P':
+                continue
+
+            record = len(records)
+            records.append(RECORD.pack(
+                float(columns[LATITUDE]),
+                float(columns[LONGITUDE]),
+                population,
+                columns[FEATURE_CLASS].encode('ascii'),
+                country.encode('ascii')[:2],
+                columns[ADMIN1_CODE].encode('utf-8')[:20],
+            ))
+            for name in {normalize_name(columns[NAME]), normalize_name(columns[ASCII_NAME])}:
+                if name:
+                    entries.append((name.encode('utf-8'), record))
+
+    entries.sort()
+    strings = bytearray()
+    offsets = {}
+    packed_entries = []
+    for key, record in entries:
+        if key not in offsets:
+            offsets[key] = len(strings)
+            strings += key
+        packed_entries.append(ENTRY.pack(offsets[key], len(key), record))
+
+    countries = json.dumps({
+        'codes': country_codes,
+        'places': {code: [lat, lng] for code, (lat, lng, _) in country_places.items()},
+    }).encode('utf-8')
+
+    with open(output_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records), len(packed_entries),
+                            len(strings), len(countries)))
+        f.write(b''.join(records))
+        f.write(b''.join(packed_entries))
+        f.write(strings)
+        f.write(countries)
+
+    logging.info('Indexed %s places under %s names and %s countries',
+                 len(records), len(packed_entries), len(country_places))
+
+
+class OfflineGeocoder:
+    """Resolves parsed locations from a memory-mapped index file.
+
+    Lookups binary search the sorted name entries directly in the mapped
+    file, so loading the index costs one mmap call no matter how large
+    the dump was, and pages are only read from disk as they're touched."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.record_count, self.entry_count, strings_size, countries_size = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path} is not a geocoder index")
+
+        self._records_at = HEADER.size
+        self._entries_at = self._records_at + self.record_count * RECORD.size
+        self._strings_at = self._entries_at + self.entry_count * ENTRY.size
+        countries_at = self._strings_at + strings_size
+
+        countries = json.loads(self._map[countries_at:countries_at + countries_size])
+        self.country_codes = countries['codes']
+        self.country_places = countries['places']
+
+    def close(self):
+        self._map.close()
+
+    def _key(self, i):
+        offset, length, record = ENTRY.unpack_from(self._map, self._entries_at + i * ENTRY.size)
+        start = self._strings_at + offset
+        return self._map[start:start + length], record
+
+    def _records_named(self, name):
+        "Returns the record numbers of every place with the given name."
+        key = normalize_name(name).encode('utf-8')
+        lo, hi = 0, self.entry_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        found = []
+        while lo < self.entry_count:
+            entry_key, record = self._key(lo)
+            if entry_key != key:
+                break
+            found.append(record)
+            lo += 1
+        return found
+
+    def _record(self, i):
+        lat, lng, population, feature_class, country, admin1 = \
+            RECORD.unpack_from(self._map, self._records_at + i * RECORD.size)
+        return {
+            'lat': repr(lat),
+            'lng': repr(lng),
+            'population': population,
+            'fcl': feature_class.decode('ascii'),
+            'countryCode': country.decode('ascii'),
+            'adminCode1': admin1.rstrip(b'\x00').decode('utf-8'),
+        }
+
+    def resolve(self, location, admin1_code=None):
+        """Returns a GeoNames-style result with lat, lng, adminCode1 and
+        countryCode for a location from update_data.parse_location, or None
+        if the index can't resolve it. When several places match, the most
+        populous one wins."""
+        country_code = self.country_codes.get(normalize_name(location['country_name']))
+        if not country_code:
+            return None
+
+        if location['type'] == 'country':
+            place = self.country_places.get(country_code)
+            if not place:
+                return None
+            return {'lat': place[0], 'lng': place[1],
+                    'adminCode1': '', 'countryCode': country_code}
+
+        candidates = [self._record(i) for i in self._records_named(location['base_name'])]
+        candidates = [c for c in candidates if c['countryCode'] == country_code]
+        if admin1_code:
+            candidates = [c for c in candidates if c['adminCode1'] == admin1_code]
+        if not candidates:
+            return None
+
+        return max(candidates, key=lambda c: c['population'])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='build an index from GeoNames dumps')
+    build.add_argument('dumps', nargs='+', metavar='DUMP',
+                       help='GeoNames dump files, such as cities500.txt')
+    build.add_argument('--country-info', required=True, metavar='FILE',
+                       help='GeoNames countryInfo.txt')
+    build.add_argument('--output', default='geonames.idx', metavar='FILE')
+    args = parser.parse_args()
+
+    build_index(args.dumps, args.country_info, args.output)
@@ -0,0 +1,202 @@
+"""
+Bounded-memory, multi-threaded processing pipelines for data ingest
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import queue
+import threading
+import time
+
+# Marks the end of a stream, or carries an upstream exception, between stages
+_DONE = object()
+
+
+class StageStats:
+    "Counts the items a pipeline stage handled and the time it spent on them."
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.records = 0
+        self.busy_seconds = 0.0
+
+    def record(self, item, elapsed):
+        self.items += 1
+        self.records += len(item) if hasattr(item, '__len__') else 1
+        self.busy_seconds += elapsed
+
+    def log(self, wall_seconds):
+        rate = self.records / self.busy_seconds if self.busy_seconds else 0.0
+        logging.info('Stage %s: %s items, %s records, %.2fs busy of %.2fs'
+                     ' (%.0f records/s)', self.name, self.items, self.records,
+                     self.busy_seconds, wall_seconds, rate)
+
+
+class Progress:
+    """Logs how far a long-running step has got through its items,
+    with its rate and estimated time remaining, every `interval` seconds."""
+
+    def __init__(self, name, total, interval=10.0):
+        self.name = name
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self._started = self._logged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def advance(self, count=1):
+        with self._lock:
+            self.done += count
+            now = time.monotonic()
+            if self.done < self.total and now - self._logged < self.interval:
+                return
+            self._logged = now
+
+        elapsed = now - self._started
+        rate = self.done / elapsed if elapsed else 0.0
+        remaining = (self.total - self.done) / rate if rate else 0.0
+        logging.info('%s: %s of %s (%.0f%%), %.2f/s, about %s remaining',
+                     self.name, self.done, self.total,
+                     100.0 * self.done / self.total if self.total else 100.0,
+                     rate, format_duration(remaining))
+
+
+def format_duration(seconds):
+    "Formats a number of seconds as, e.g., 1h02m or 3m05s."
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f'{seconds // 3600}h{seconds % 3600 // 60:02d}m'
+    return f'{seconds // 60}m{seconds % 60:02d}s'
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class Pipeline:
+    """Runs a source iterable through a chain of stages, each in its own
+    thread, with a bounded queue between consecutive stages.
+
+    A stage is a (name, function) pair; the function takes one item and
+    returns the item to pass on. The last stage runs in the calling thread.
+    Because every queue holds at most `queue_size` items, a slow stage
+    pauses the ones before it instead of letting items pile up in memory."""
+
+    def __init__(self, source, stages, source_name='fetch', queue_size=4):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = [StageStats(source_name)] + \
+            [StageStats(name) for name, _ in stages]
+        self._stop = threading.Event()
+
+    def _put(self, out, item):
+        "Hands an item downstream, giving up if the pipeline is stopping."
+        while not self._stop.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, inbox):
+        "Takes the next item from upstream, or _DONE if the pipeline is stopping."
+        while not self._stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _DONE
+
+    def _produce(self, out):
+        stats = self.stats[0]
+        items = iter(self.source)
+        try:
+            while not self._stop.is_set():
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                stats.record(item, time.perf_counter() - start)
+                if not self._put(out, item):
+                    break
+            self._put(out, _DONE)
+        except BaseException as e:  # pylint: disable=broad-except
+            self._put(out, _Failure(e))
+        finally:
+            close = getattr(items, 'close', None)
+            if close:
+                close()
+
+    def _transform(self, stats, fn, inbox, out):
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is _DONE or isinstance(item, _Failure):
+                    self._put(out, item)
+                    return
+
+                start = time.perf_counter()
+                result = fn(item)
+                stats.record(item, time.perf_counter() - start)
+                if not self._put(out, result):
+                    return
+        except BaseException as e:  # pylint: disable=broad-except
+            self._put(out, _Failure(e))
+
+    def run(self):
+        "Runs the pipeline to completion, re-raising any stage's exception."
+        started = time.perf_counter()
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        threads = [threading.Thread(target=self._produce, args=(queues[0],),
+                                    name='pipeline-' + self.stats[0].name, daemon=True)]
+        for i, (name, fn) in enumerate(self.stages[:-1]):
+            threads.append(threading.Thread(
+                target=self._transform,
+                args=(self.stats[i + 1], fn, queues[i], queues[i + 1]),
+                name='pipeline-' + name, daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        _, sink = self.stages[-1]
+        sink_stats = self.stats[-1]
+        inbox = queues[-1]
+        try:
+            while True:
+                item = inbox.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, _Failure):
+                    raise item.error
+
+                start = time.perf_counter()
+                sink(item)
+                sink_stats.record(item, time.perf_counter() - start)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        wall_seconds = time.perf_counter() - started
+        for stats in self.stats:
+            stats.log(wall_seconds)
+        return self.stats
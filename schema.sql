@@ -16,6 +16,16 @@ CREATE TABLE IF NOT EXISTS locations (
   short_name TEXT NULL
 );
 
+-- Numbers the 0.01 degree (about 1 km) grid cell containing a coordinate.
+-- Cells are numbered row by row, so the cells of one row between two
+-- longitudes form a contiguous range of keys.
+CREATE OR REPLACE FUNCTION geo_grid_cell(lat DOUBLE PRECISION, lng DOUBLE PRECISION)
+RETURNS BIGINT
+LANGUAGE SQL IMMUTABLE PARALLEL SAFE
+AS $$
+  SELECT floor((lat + 90) * 100)::BIGINT * 100000 + floor((lng + 180) * 100)::BIGINT
+$$;
+
 CREATE TABLE IF NOT EXISTS geolocations (
   location_id INTEGER REFERENCES locations (location_id) PRIMARY KEY,
   name TEXT NOT NULL,
@@ -24,10 +34,19 @@ CREATE TABLE IF NOT EXISTS geolocations (
   subdivision_code TEXT NULL,
   country_name TEXT NOT NULL,
   country_code TEXT NOT NULL,
-  lat TEXT NOT NULL,
-  lng TEXT NOT NULL
+  lat DOUBLE PRECISION NOT NULL,
+  lng DOUBLE PRECISION NOT NULL,
+  grid_cell BIGINT GENERATED ALWAYS AS (geo_grid_cell(lat, lng)) STORED,
+  reconciled BOOLEAN NOT NULL DEFAULT FALSE
 );
 
+CREATE INDEX IF NOT EXISTS geolocations_grid_cell
+  ON geolocations (grid_cell);
+
+-- Geolocations not yet checked for duplicates by reconcile_duplicates()
+CREATE INDEX IF NOT EXISTS geolocations_unreconciled
+  ON geolocations (location_id) WHERE NOT reconciled;
+
 CREATE TABLE IF NOT EXISTS location_affiliations (
   person_id INTEGER NOT NULL REFERENCES people (person_id),
   location_id INTEGER NOT NULL REFERENCES locations (location_id),
@@ -47,11 +66,78 @@ CREATE TABLE IF NOT EXISTS stints (
   PRIMARY KEY (person_id, start_date)
 );
 
+CREATE INDEX IF NOT EXISTS location_affiliations_location_id
+  ON location_affiliations (location_id);
+
+-- For filtering the map by batch, stint type and date
+CREATE INDEX IF NOT EXISTS stints_batch_id
+  ON stints (batch_id);
+CREATE INDEX IF NOT EXISTS stints_stint_type_start_date
+  ON stints (stint_type, start_date);
+
 CREATE TABLE IF NOT EXISTS location_aliases (
   location_id INTEGER NOT NULL REFERENCES locations (location_id) PRIMARY KEY,
   preferred_location_id INTEGER NOT NULL REFERENCES locations (location_id)
 );
 
+CREATE TABLE IF NOT EXISTS geocode_cache (
+  query TEXT NOT NULL,
+  feature_classes TEXT NOT NULL,
+  max_rows INTEGER NOT NULL,
+  result JSONB NOT NULL,
+  fetched_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (query, feature_classes, max_rows)
+);
+
+CREATE TABLE IF NOT EXISTS geocode_jobs (
+  location_id INTEGER NOT NULL PRIMARY KEY,
+  status TEXT NOT NULL,
+  error TEXT,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS person_fingerprints (
+  person_id INTEGER NOT NULL REFERENCES people (person_id) PRIMARY KEY,
+  fingerprint TEXT NOT NULL,
+  synced_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS sync_runs (
+  run_id SERIAL PRIMARY KEY,
+  mode TEXT NOT NULL,
+  started_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  finished_at TIMESTAMPTZ NULL,
+  people_seen INTEGER NOT NULL DEFAULT 0,
+  people_changed INTEGER NOT NULL DEFAULT 0,
+  rows_touched INTEGER NOT NULL DEFAULT 0,
+  -- {phase: {records, seconds}} as returned by process_rc_data()
+  phases JSONB NULL
+);
+
+CREATE TABLE IF NOT EXISTS dataset_version (
+  singleton BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (singleton),
+  version BIGINT NOT NULL DEFAULT 0,
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  -- location_changes only covers the versions after this one
+  compacted_through BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO dataset_version DEFAULT VALUES ON CONFLICT DO NOTHING;
+
+-- A hash of each location as served by /api/locations/all,
+-- compared after every refresh to find the locations that changed
+CREATE TABLE IF NOT EXISTS location_fingerprints (
+  location_id INTEGER PRIMARY KEY,
+  fingerprint TEXT NOT NULL
+);
+
+-- The locations added, changed or removed in each dataset version
+CREATE TABLE IF NOT EXISTS location_changes (
+  version BIGINT NOT NULL,
+  location_id INTEGER NOT NULL,
+  PRIMARY KEY (version, location_id)
+);
+
 CREATE VIEW stints_for_people AS
 SELECT
   stints.person_id,
@@ -113,7 +199,9 @@ GROUP BY a.location_id, a.name,
   b.location_id, b.type, b.location_name
 ORDER BY a.location_id;
 
-CREATE VIEW geolocations_popl_by_country_agg AS
+-- The aggregates below are materialized and only change when
+-- update_data.refresh_aggregates() runs after new data is written.
+CREATE MATERIALIZED VIEW geolocations_popl_by_country_agg AS
 SELECT 
   location_id,
   country_name,
@@ -123,7 +211,10 @@ FROM geolocations_popl_by_country
 GROUP BY location_id, country_name
 ORDER BY location_id;
 
-CREATE VIEW geolocations_people_and_stints_agg AS
+CREATE UNIQUE INDEX geolocations_popl_by_country_agg_location_id
+  ON geolocations_popl_by_country_agg (location_id);
+
+CREATE MATERIALIZED VIEW geolocations_people_and_stints_agg AS
 SELECT
   g.location_id,
   g.location_name,
@@ -139,7 +230,7 @@ SELECT
           'image_url', image_url,
           'stints', stints
       )
-      ORDER BY person_name
+      ORDER BY person_name, g.person_id
   ) AS person_list
 FROM geolocations_with_affiliated_people AS g
 INNER JOIN stints_for_people_agg AS s
@@ -148,4 +239,61 @@ LEFT JOIN geolocations_popl_by_country_agg p
   ON p.location_id = g.location_id
 GROUP BY g.location_id, g.location_name, g.type, g.lat, g.lng,
   p.city_count, p.total_population
-ORDER BY g.location_id;
\ No newline at end of file
+ORDER BY g.location_id;
+
+CREATE UNIQUE INDEX geolocations_people_and_stints_agg_location_id
+  ON geolocations_people_and_stints_agg (location_id);
+
+-- Returns everything /api/locations/<id> serves for a location, as one
+-- JSON document: its alias is resolved, and it has its people if it has
+-- any, or else its geolocation and, for a country, its population.
+-- Returns NULL if the location hasn't been geocoded yet. PL/pgSQL keeps
+-- the plans of these statements for the session, so calls skip planning.
+CREATE OR REPLACE FUNCTION location_document(requested_id INTEGER)
+RETURNS JSON
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+  resolved_id INTEGER;
+  document JSON;
+BEGIN
+  SELECT preferred_location_id INTO resolved_id
+  FROM location_aliases
+  WHERE location_id = requested_id;
+  resolved_id := COALESCE(resolved_id, requested_id);
+
+  SELECT json_build_object(
+      'location_id', p.location_id,
+      'location_name', p.location_name,
+      'type', p.type,
+      'lat', p.lat,
+      'lng', p.lng,
+      'city_count', p.city_count,
+      'total_population', p.total_population,
+      'has_rc_people', TRUE,
+      'person_list', p.person_list
+    ) INTO document
+  FROM geolocations_people_and_stints_agg p
+  WHERE p.location_id = resolved_id;
+  IF FOUND THEN
+    RETURN document;
+  END IF;
+
+  SELECT json_strip_nulls(json_build_object(
+      'location_id', g.location_id,
+      'location_name', g.name,
+      'type', g.type,
+      'lat', g.lat,
+      'lng', g.lng,
+      'has_rc_people', FALSE,
+      'city_count', c.city_count,
+      'total_population', c.total_population
+    )) INTO document
+  FROM geolocations g
+  LEFT JOIN geolocations_popl_by_country_agg c
+    ON c.location_id = g.location_id
+    AND g.type <> 'city'
+  WHERE g.location_id = resolved_id;
+  RETURN document;
+END
+$$;
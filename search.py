@@ -0,0 +1,81 @@
+"""
+Prefix search over the locations known to the Recurse World Map
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from bisect import bisect_left
+import re
+import unicodedata
+
+NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize(text):
+    """Lowercases text and strips accents and punctuation,
+    so "Montréal, QC" and "montreal qc" compare equal."""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+    return NON_WORD.sub(' ', stripped.casefold()).strip()
+
+
+class LocationSearchIndex:
+    """An in-memory index answering "which locations have words starting
+    with each of these prefixes", ranked by the number of RCers there.
+
+    Every word of every location's name and short name is kept in one
+    sorted list, so each query term costs a binary search plus a scan
+    over the words that actually share its prefix."""
+
+    def __init__(self, locations):
+        """Builds the index from dicts with the keys id, name, short_name,
+        type and population."""
+        self.locations = sorted(
+            locations,
+            key=lambda l: (-(l['population'] or 0), len(l['name']), l['name']))
+
+        words = set()
+        for rank, location in enumerate(self.locations):
+            text = normalize(location['name']) + ' ' + \
+                normalize(location.get('short_name'))
+            words.update((word, rank) for word in text.split())
+
+        self.words = sorted(words)
+
+    def _ranks_with_prefix(self, prefix):
+        ranks = set()
+        i = bisect_left(self.words, (prefix, -1))
+        while i < len(self.words) and self.words[i][0].startswith(prefix):
+            ranks.add(self.words[i][1])
+            i += 1
+        return ranks
+
+    def search(self, query, limit=10):
+        """Returns up to `limit` locations matching every word in the query,
+        most populous first."""
+        terms = normalize(query).split()
+        if not terms:
+            return []
+
+        # Narrow down with the longest (most selective) term first
+        terms.sort(key=len, reverse=True)
+        ranks = self._ranks_with_prefix(terms[0])
+        for term in terms[1:]:
+            if not ranks:
+                break
+            ranks &= self._ranks_with_prefix(term)
+
+        return [self.locations[rank] for rank in sorted(ranks)[:limit]]
@@ -1,15 +1,21 @@
-export function localFetch(beforeFetchMsg, url, responseMsg) {
+import { decodeColumnar } from "./columnar";
+
+export function localFetch(beforeFetchMsg, url, responseMsg, onResponse) {
   console.log(beforeFetchMsg);
 
   return fetch(url, {
     accept: "application/json"
   })
     .then(response => {
+      if (onResponse) {
+        onResponse(response);
+      }
       return response.json();
     })
     .then(responseJson => {
       if (responseJson.message === "Access Denied") {
         console.log("Access denied!");
+        clearCachedLocations();
         window.location.pathname = "auth/recurse";
       } else {
         console.log(responseMsg, responseJson);
@@ -18,12 +24,101 @@ export function localFetch(beforeFetchMsg, url, responseMsg) {
     });
 }
 
+const LOCATIONS_CACHE_KEY = "worldmap.locations";
+
+// Returning visitors start from the locations saved on their last visit
+// and only download the ones that changed since
 export function getRcLocations() {
+  const cached = loadCachedLocations();
+  if (!cached) {
+    return getAllRcLocations();
+  }
+
+  let ok = false;
+  return localFetch(
+    "API: Get geolocation changes since version " + cached.version,
+    "/api/locations/changes?since=" + cached.version,
+    "Geolocation Changes: ",
+    response => {
+      ok = response.ok;
+    }
+  )
+    .catch(error => {
+      console.log("Could not get geolocation changes: ", error);
+      return null;
+    })
+    .then(changes => {
+      if (changes === undefined) {
+        // Access denied; on the way to logging in
+        return changes;
+      } else if (
+        !ok ||
+        !changes ||
+        changes["full_reload"] ||
+        !Array.isArray(changes["changed"]) ||
+        !Array.isArray(changes["removed"])
+      ) {
+        // An error, or too many changes to send: load everything again
+        return getAllRcLocations();
+      }
+      const locations = applyLocationChanges(cached.locations, changes);
+      saveCachedLocations(changes["version"], locations);
+      return locations;
+    });
+}
+
+function getAllRcLocations() {
+  let version = null;
   return localFetch(
     "API: Get all geolocation data",
-    "/api/locations/all",
-    "Geolocation Data: "
-  );
+    "/api/locations/all?format=columnar",
+    "Geolocation Data: ",
+    response => {
+      version = response.headers.get("X-Dataset-Version");
+    }
+  ).then(payload => {
+    if (!payload) {
+      return payload;
+    }
+    const locations = decodeColumnar(payload);
+    if (version !== null) {
+      saveCachedLocations(Number(version), locations);
+    }
+    return locations;
+  });
+}
+
+function applyLocationChanges(locations, changes) {
+  const byId = new Map(locations.map(location => [location.location_id, location]));
+  changes["removed"].forEach(id => byId.delete(id));
+  changes["changed"].forEach(location => byId.set(location.location_id, location));
+  return Array.from(byId.values()).sort((a, b) => a.location_id - b.location_id);
+}
+
+function loadCachedLocations() {
+  try {
+    return JSON.parse(window.localStorage.getItem(LOCATIONS_CACHE_KEY));
+  } catch (e) {
+    return null;
+  }
+}
+
+function saveCachedLocations(version, locations) {
+  try {
+    window.localStorage.setItem(
+      LOCATIONS_CACHE_KEY,
+      JSON.stringify({ version: version, locations: locations })
+    );
+  } catch (e) {
+    // Storage is full or disabled; the next visit loads everything again
+    clearCachedLocations();
+  }
+}
+
+function clearCachedLocations() {
+  try {
+    window.localStorage.removeItem(LOCATIONS_CACHE_KEY);
+  } catch (e) {}
 }
 
 export function getLocationSuggestions(query) {
@@ -40,11 +135,43 @@ export function getLocationData(location) {
   const shortName = location["short_name"];
   const type = location["type"];
 
+  const url = `/api/locations/${id}?name=${name}&short_name=${shortName}&type=${type}`;
+
   return localFetch(
     `API: Location lookup, id: ${id}, name: ${name}`,
-    `/api/locations/${id}?name=${name}&short_name=${shortName}&type=${type}`,
+    url,
     "Location lookup results "
-  );
+  ).then(result => {
+    // New locations are geocoded in the background; wait until it's done
+    if (result["status"] === "pending") {
+      return waitForGeocoding(result["status_url"], url);
+    }
+    return result;
+  });
+}
+
+const GEOCODING_POLL_INTERVAL_MS = 1000;
+
+function waitForGeocoding(statusUrl, locationUrl) {
+  return new Promise(resolve =>
+    setTimeout(resolve, GEOCODING_POLL_INTERVAL_MS)
+  )
+    .then(() =>
+      localFetch("API: Geocoding status", statusUrl, "Geocoding status ")
+    )
+    .then(status => {
+      if (status["status"] === "pending") {
+        return waitForGeocoding(statusUrl, locationUrl);
+      } else if (status["status"] === "done") {
+        return localFetch(
+          "API: Location lookup",
+          locationUrl,
+          "Location lookup results "
+        );
+      }
+      // Geocoding failed; callers treat an empty result as not found
+      return {};
+    });
 }
 
 export function getCurrentUser() {
@@ -0,0 +1,40 @@
+// Decodes the compact columnar /api/locations/all payload (see columnar.py)
+// back into the list of location objects the plain JSON format returns.
+
+export function decodeColumnar(payload) {
+  if (payload.format !== "columnar" || payload.version !== 1) {
+    throw new Error("Not a version 1 columnar payload");
+  }
+  return decodeTable(payload.table, payload.strings);
+}
+
+function decodeTable(table, strings) {
+  const columns = {};
+  for (const [field, column] of Object.entries(table.columns)) {
+    if (Array.isArray(column)) {
+      columns[field] = column;
+    } else if ("constant" in column) {
+      columns[field] = new Array(table.length).fill(column.constant);
+    } else if ("interned" in column) {
+      columns[field] = column.interned.map(index => strings[index]);
+    } else {
+      const children = decodeTable(column.nested.table, strings);
+      let start = 0;
+      columns[field] = column.nested.counts.map(count => {
+        start += count;
+        return children.slice(start - count, start);
+      });
+    }
+  }
+
+  const fields = Object.keys(columns);
+  const records = new Array(table.length);
+  for (let i = 0; i < table.length; i++) {
+    const record = {};
+    for (const field of fields) {
+      record[field] = columns[field][i];
+    }
+    records[i] = record;
+  }
+  return records;
+}
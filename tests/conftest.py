@@ -0,0 +1,48 @@
+"""
+Shared fixtures for the tests
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import uuid
+import pytest
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'schema.sql')
+
+
+@pytest.fixture
+def scratch_cursor():
+    """A cursor on a new schema created from schema.sql in the DATABASE_URL
+    database. Everything runs in one transaction, which is rolled back
+    afterwards, so the database is left as it was."""
+    database_url = os.environ.get('DATABASE_URL')
+    if not database_url:
+        pytest.skip('DATABASE_URL is not set')
+    psycopg2 = pytest.importorskip('psycopg2')
+
+    connection = psycopg2.connect(database_url)
+    try:
+        cursor = connection.cursor()
+        schema = 'test_' + uuid.uuid4().hex
+        cursor.execute(f'CREATE SCHEMA {schema}')
+        cursor.execute(f'SET LOCAL search_path TO {schema}')
+        with open(SCHEMA_PATH) as schema_file:
+            cursor.execute(schema_file.read())
+        yield cursor
+    finally:
+        connection.rollback()
+        connection.close()
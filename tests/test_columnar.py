@@ -0,0 +1,127 @@
+"""
+Round trips of the /api/locations/all payload through the columnar encoding
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import pytest
+import columnar
+
+
+def person(person_id, name, stints):
+    return {
+        'person_id': person_id,
+        'name': name,
+        'image_url': f'https://example.com/{person_id}.png',
+        'stints': stints,
+    }
+
+
+def stint(batch_name, start_date, stint_type='retreat', rc_title=None):
+    return {
+        'stint_type': stint_type,
+        'rc_title': rc_title,
+        'batch_name': batch_name,
+        'start_date': start_date,
+    }
+
+
+# Shaped like get_locations_with_people(): every location has people, so
+# has_rc_people is constant, while type and batch names are interned
+LOCATIONS = [
+    {
+        'location_id': 10,
+        'location_name': 'New York City, NY',
+        'type': 'city',
+        'lat': 40.7128,
+        'lng': -74.006,
+        'city_count': 0,
+        'total_population': 0,
+        'has_rc_people': True,
+        'person_list': [
+            person(1, 'Ada', [stint("W1'19", '2019-01-07'),
+                              stint(None, '2020-06-01', 'residency', 'Resident')]),
+            person(2, 'Grace', [stint("W1'19", '2019-01-07')]),
+            person(3, 'Linus', []),
+        ],
+    },
+    {
+        'location_id': 20,
+        'location_name': 'United States',
+        'type': 'country',
+        'lat': 39.76,
+        'lng': -98.5,
+        'city_count': 1,
+        'total_population': 3,
+        'has_rc_people': True,
+        'person_list': [
+            person(4, 'Édouard', [stint("SP2'21", '2021-04-05')]),
+        ],
+    },
+    {
+        'location_id': 30,
+        'location_name': 'Berlin, Germany',
+        'type': 'city',
+        'lat': 52.52,
+        'lng': 13.405,
+        'city_count': 0,
+        'total_population': 0,
+        'has_rc_people': True,
+        'person_list': [],
+    },
+]
+
+
+def json_round_trip(payload):
+    return json.loads(json.dumps(payload))
+
+
+def msgpack_round_trip(payload):
+    msgpack = pytest.importorskip('msgpack')
+    return msgpack.unpackb(msgpack.packb(payload))
+
+
+@pytest.fixture(params=[json_round_trip, msgpack_round_trip], ids=['json', 'msgpack'])
+def round_trip(request):
+    return request.param
+
+
+@pytest.mark.parametrize('records', [
+    LOCATIONS,
+    LOCATIONS[:1],
+    LOCATIONS[2:],
+    [],
+], ids=['locations', 'single-row', 'empty-person-list', 'empty'])
+def test_round_trip(records, round_trip):
+    assert columnar.decode(round_trip(columnar.encode(records))) == records
+
+
+def test_column_kinds():
+    columns = columnar.encode(LOCATIONS)['table']['columns']
+    assert columns['has_rc_people'] == {'constant': True}
+    assert 'interned' in columns['type']
+    assert columns['location_id'] == [10, 20, 30]
+    assert columns['person_list']['nested']['counts'] == [3, 1, 0]
+
+    # A single row is stored as a list, not as a constant
+    single = columnar.encode(LOCATIONS[:1])['table']['columns']
+    assert single['has_rc_people'] == [True]
+
+
+def test_rejects_other_payloads():
+    with pytest.raises(ValueError):
+        columnar.decode({'format': 'columnar', 'version': columnar.FORMAT_VERSION + 1})
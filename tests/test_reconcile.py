@@ -0,0 +1,271 @@
+"""
+Checks that the set-based reconcile_duplicates() aliases and reassigns
+the same locations as the per-row version it replaced
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+
+# update_data reads this at import time, though these tests never geocode
+os.environ.setdefault('GEONAMES_USERNAME', 'test')
+
+import update_data  # noqa: E402  pylint: disable=wrong-import-position
+
+# (location_id, lat, lng, number of people, reconciled, aliased to)
+GEOLOCATIONS = [
+    # Near-duplicates; 102 has the most people
+    (101, 40.7128, -74.0060, 1, False, None),
+    (102, 40.7131, -74.0057, 3, False, None),
+    (103, 40.7125, -74.0063, 2, False, None),
+    # A chain: 201 and 203 are only duplicates by way of 202
+    (201, 51.5072, -0.1276, 2, False, None),
+    (202, 51.5080, -0.1268, 0, False, None),
+    (203, 51.5088, -0.1260, 1, False, None),
+    # A tie, which goes to the lower id
+    (301, 48.8566, 2.3522, 2, False, None),
+    (302, 48.8570, 2.3525, 2, False, None),
+    # 501 was aliased to 502 by an earlier run, but a profile points
+    # someone at it again; 503 is new and close to both
+    (501, 35.6762, 139.6503, 1, True, 502),
+    (502, 35.6765, 139.6506, 2, True, None),
+    (503, 35.6768, 139.6500, 1, False, None),
+    # Reconciled and new locations with no duplicates
+    (601, -33.8688, 151.2093, 2, True, None),
+    (602, -23.5505, -46.6333, 1, False, None),
+]
+
+# Exact duplicates only, which the original GROUP BY lat, lng version
+# could find. Each group has one location with the most people.
+EXACT_GEOLOCATIONS = [
+    (701, 41.3851, 2.1734, 1, False, None),
+    (702, 41.3851, 2.1734, 4, False, None),
+    (703, 41.3851, 2.1734, 2, False, None),
+    (801, 52.5200, 13.4050, 2, False, None),
+    (802, 52.5200, 13.4050, 1, False, None),
+    (901, 59.3293, 18.0686, 3, False, None),
+]
+
+# Duplicates that an earlier run already looked at and left alone, with
+# no new location near them
+RECONCILED_GEOLOCATIONS = [
+    (1001, 45.4642, 9.1900, 1, True, None),
+    (1002, 45.4645, 9.1903, 3, True, None),
+    (1101, 19.4326, -99.1332, 0, True, 1102),
+    (1102, 19.4329, -99.1335, 1, True, None),
+]
+
+
+def insert_fixtures(cursor, geolocations=GEOLOCATIONS):
+    for location_id, lat, lng, population, reconciled, alias in geolocations:
+        name = f'Location {location_id}'
+        cursor.execute("INSERT INTO locations VALUES (%s, %s, NULL)", [location_id, name])
+        update_data.insert_geo_data(cursor, {
+            'location_id': location_id,
+            'name': name,
+            'type': 'city',
+            'country_name': 'Country',
+            'country_code': 'CC',
+            'lat': lat,
+            'lng': lng,
+        })
+        cursor.execute("UPDATE geolocations SET reconciled = %s WHERE location_id = %s",
+                       [reconciled, location_id])
+        for i in range(population):
+            person_id = location_id * 10 + i
+            cursor.execute("INSERT INTO people VALUES (%s, %s, NULL)",
+                           [person_id, f'Person {person_id}'])
+            cursor.execute("INSERT INTO location_affiliations" +
+                           " VALUES (%s, %s, NULL, NULL, 'current_location')",
+                           [person_id, location_id])
+
+    for location_id, _, _, _, _, alias in geolocations:
+        if alias:
+            cursor.execute("INSERT INTO location_aliases VALUES (%s, %s)",
+                           [location_id, alias])
+
+
+def reconcile_duplicates_original(cursor):
+    """reconcile_duplicates() as first written: only locations with
+    exactly the same coordinates are duplicates, and each alias and
+    affiliation update is written separately."""
+    cursor.execute("""SELECT
+                        json_agg(
+                            json_build_object(
+                                'location_id', g.location_id,
+                                'population', population
+                            )
+                        ) AS counts
+                      FROM geolocations g
+                      LEFT JOIN (
+                          SELECT
+                            location_id,
+                            COALESCE(COUNT(person_id), 0) AS population
+                          FROM location_affiliations
+                          GROUP BY location_id
+                        ) AS p
+                      ON g.location_id = p.location_id
+                      GROUP BY lat, lng HAVING count(*) > 1""")
+
+    for (counts,) in cursor.fetchall():
+        preferred_index = None
+        max_count = 0
+        for i, loc in enumerate(counts):
+            pop = loc["population"]
+            if (pop and pop > max_count):
+                max_count = pop
+                preferred_index = i
+
+        preferred = counts.pop(preferred_index)["location_id"]
+        for loc in counts:
+            cursor.execute("INSERT INTO location_aliases" +
+                           " (location_id, preferred_location_id)" +
+                           " VALUES (%s, %s)" +
+                           " ON CONFLICT (location_id) DO NOTHING",
+                           [loc["location_id"], preferred])
+            cursor.execute("""UPDATE location_affiliations
+                              SET location_id = %s
+                              WHERE location_id = %s""",
+                           [preferred, loc["location_id"]])
+
+
+def reconcile_duplicates_per_row(cursor):
+    """The per-row reconcile_duplicates() from just before the set-based
+    rewrite, once duplicates were matched within the coordinate
+    tolerance: compares every geolocation, and writes one alias and one
+    affiliation update per duplicate."""
+    cursor.execute("""SELECT
+                        a.location_id,
+                        b.location_id
+                      FROM geolocations a
+                      CROSS JOIN LATERAL """ +
+                   update_data.NEARBY_GEOLOCATIONS.format(lat='a.lat', lng='a.lng') + """
+                      WHERE a.location_id < b.location_id""",
+                   {'tolerance': update_data.coordinate_tolerance})
+
+    groups = {}
+    for a, b in cursor.fetchall():
+        group = groups.setdefault(a, {a})
+        other = groups.get(b, {b})
+        if other is not group:
+            group |= other
+            for location_id in other:
+                groups[location_id] = group
+
+    for group in {id(group): group for group in groups.values()}.values():
+        cursor.execute("""SELECT location_id, COUNT(person_id)
+                          FROM location_affiliations
+                          WHERE location_id = ANY(%s)
+                          GROUP BY location_id""", [list(group)])
+        population = dict(cursor.fetchall())
+
+        preferred = None
+        max_count = 0
+        for location_id in sorted(group):
+            if population.get(location_id, 0) > max_count:
+                max_count = population[location_id]
+                preferred = location_id
+
+        for location_id in sorted(group - {preferred}):
+            cursor.execute("INSERT INTO location_aliases" +
+                           " (location_id, preferred_location_id)" +
+                           " VALUES (%s, %s)" +
+                           " ON CONFLICT (location_id) DO NOTHING",
+                           [location_id, preferred])
+            cursor.execute("""UPDATE location_affiliations
+                              SET location_id = %s
+                              WHERE location_id = %s""",
+                           [preferred, location_id])
+
+
+def snapshot(cursor):
+    cursor.execute("SELECT location_id, preferred_location_id FROM location_aliases ORDER BY 1")
+    aliases = cursor.fetchall()
+    cursor.execute("SELECT person_id, location_id FROM location_affiliations ORDER BY 1")
+    return aliases, cursor.fetchall()
+
+
+def test_set_based_reconcile_matches_per_row(scratch_cursor):
+    cursor = scratch_cursor
+    insert_fixtures(cursor)
+
+    cursor.execute("SAVEPOINT fixtures")
+    reconcile_duplicates_per_row(cursor)
+    expected = snapshot(cursor)
+    cursor.execute("ROLLBACK TO SAVEPOINT fixtures")
+
+    update_data.reconcile_duplicates(cursor)
+    aliases, affiliations = snapshot(cursor)
+
+    assert aliases == expected[0]
+    assert affiliations == expected[1]
+    assert aliases == [(101, 102), (103, 102), (202, 201), (203, 201),
+                       (302, 301), (501, 502), (503, 502)]
+
+
+def test_set_based_reconcile_matches_original_on_exact_duplicates(scratch_cursor):
+    cursor = scratch_cursor
+    insert_fixtures(cursor, EXACT_GEOLOCATIONS)
+
+    cursor.execute("SAVEPOINT fixtures")
+    reconcile_duplicates_original(cursor)
+    expected = snapshot(cursor)
+    cursor.execute("ROLLBACK TO SAVEPOINT fixtures")
+
+    update_data.reconcile_duplicates(cursor)
+
+    assert snapshot(cursor) == expected
+    assert expected[0] == [(701, 702), (703, 702), (802, 801)]
+
+
+def test_reconciled_locations_are_not_merged_again(scratch_cursor):
+    cursor = scratch_cursor
+    insert_fixtures(cursor, RECONCILED_GEOLOCATIONS)
+    before = snapshot(cursor)
+
+    update_data.reconcile_duplicates(cursor)
+
+    assert snapshot(cursor) == before
+    assert before[0] == [(1101, 1102)]
+
+
+def test_reconcile_is_idempotent(scratch_cursor):
+    cursor = scratch_cursor
+    insert_fixtures(cursor)
+
+    update_data.reconcile_duplicates(cursor)
+    first = snapshot(cursor)
+    cursor.execute("UPDATE geolocations SET reconciled = FALSE")
+    update_data.reconcile_duplicates(cursor)
+
+    assert snapshot(cursor) == first
+
+
+def test_duplicates_across_the_antimeridian(scratch_cursor):
+    cursor = scratch_cursor
+    insert_fixtures(cursor, [
+        (1201, -16.5000, 179.9996, 2, False, None),
+        (1202, -16.5003, -179.9997, 1, False, None),
+        (1301, 0.0, 179.5, 1, False, None),
+        (1302, 0.0, -179.5, 1, False, None),
+    ])
+
+    nearby = update_data.find_nearby_location(cursor, -16.5001, -179.9999, 1202)
+    assert nearby['location_id'] == 1201
+
+    update_data.reconcile_duplicates(cursor)
+    aliases, _ = snapshot(cursor)
+    assert aliases == [(1202, 1201)]
@@ -10,14 +10,22 @@ data. The database schema must already exist.
 
 import time
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 import logging
 import psycopg2
+import random
+from psycopg2.extras import Json, execute_values
 import sys
 import os
 import geocoder
-import requests
 from dotenv import load_dotenv
+import metrics
+from offline_geocoder import OfflineGeocoder
+from pipeline import Pipeline, Progress
+from upstream import RC_API_URL, TokenBucket, UpstreamClient
 
 
 logging.basicConfig(level=logging.INFO)
@@ -37,93 +45,120 @@ def get_env_var(var_name, fallback=""):
     return value
 
 
-def get_people(token):
+def rc_api_client(token, pool_size=10):
+    "Returns a client for the RC API authenticated with the given token."
+    return UpstreamClient(get_env_var('RC_API_URL', RC_API_URL), token=token,
+                          name='RC API', pool_size=pool_size)
+
+
+def get_people(token, concurrency=4):
     people = []
 
-    session = requests.session()
-    session.headers.update({'Authorization': f'Bearer {token}'})
-    url = 'https://www.recurse.com/api/v1/profiles?limit={limit}&offset={offset}'
-    limit = 50
-    offset = 0
-
-    while True:
-        r = session.get(url.format(limit=limit, offset=offset))
-        if r.status_code != requests.codes.ok:
-            r.raise_for_status()
-        page = r.json()
-        if page == []:
-            break
+    for page in get_profile_pages(rc_api_client(token, concurrency), concurrency=concurrency):
         people.extend(page)
-        offset += limit
 
     return people
 
 
-def insert_people_data(cursor, people):
-    processed_batches = set()
-    processed_locations = set()
+def get_profile_pages(rc_api, limit=50, concurrency=4):
+    """Yields pages of RC profiles in directory order, keeping up to
+    `concurrency` page requests in flight at once.
+
+    The first empty page marks the end of the directory. A short page
+    doesn't, since the API may return fewer than `limit` profiles before
+    the end, so at most `concurrency` requests past the end are wasted."""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        next_offset = 0
+
+        def request_next_page():
+            nonlocal next_offset
+            params = {'limit': limit, 'offset': next_offset}
+            in_flight.append(executor.submit(rc_api.get_json, 'profiles', params=params))
+            next_offset += limit
+
+        for _ in range(concurrency):
+            request_next_page()
+
+        try:
+            while in_flight:
+                page = in_flight.popleft().result()
+                if not page:
+                    break
+                yield page
+                request_next_page()
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+
+class ProfileBatch:
+    "The rows to write for one page of RC profiles."
+
+    def __init__(self):
+        self.people = []
+        self.locations = []
+        self.affiliations = []
+        self.batches = []
+        self.stints = []
+        self.fingerprints = []
+
+    def __len__(self):
+        return len(self.people)
+
+    def only(self, person_ids):
+        "Returns the rows that belong to the given people."
+        rows = ProfileBatch()
+        rows.people = [p for p in self.people if p[0] in person_ids]
+        rows.affiliations = [a for a in self.affiliations if a[0] in person_ids]
+        rows.stints = [s for s in self.stints if s[0] in person_ids]
+        rows.fingerprints = [f for f in self.fingerprints if f[0] in person_ids]
+
+        location_ids = {a[1] for a in rows.affiliations}
+        rows.locations = [l for l in self.locations if l[0] in location_ids]
+        batch_ids = {s[1] for s in rows.stints}
+        rows.batches = [b for b in self.batches if b[0] in batch_ids]
+        return rows
+
+
+def fingerprint_person(person):
+    """Returns a digest of the parts of an RC profile that the map stores,
+    which changes whenever any of them do."""
+    location = person.get('current_location') or {}
+    content = [
+        person.get('id'),
+        person.get('name'),
+        person.get('image_path'),
+        [location.get('id'), location.get('name'), location.get('short_name')],
+        [[stint.get('type'),
+          stint.get('start_date'),
+          stint.get('end_date'),
+          stint.get('title'),
+          (stint.get('batch') or {}).get('id'),
+          (stint.get('batch') or {}).get('name'),
+          (stint.get('batch') or {}).get('short_name')]
+         for stint in person['stints']],
+    ]
+    encoded = json.dumps(content, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def normalize_people(people):
+    """Flattens RC API profiles into the rows stored for each person,
+    their current location, and their batches and stints."""
+    rows = ProfileBatch()
 
     for person in people:
         person_id = person.get('id')
-        name = person.get('name')
-        image_url = person.get('image_path')
-
-        logging.debug("Person #{}: {}".format(
-            person_id,
-            name
-        ))
-
-        cursor.execute("INSERT INTO people" +
-                       " (person_id, name, image_url)" +
-                       " VALUES (%s, %s, %s)" +
-                       " ON CONFLICT (person_id) DO UPDATE SET" +
-                       " name = %s," +
-                       " image_url = %s" +
-                       " WHERE people.person_id = %s",
-                       [person_id,
-                        name,
-                        image_url,
-                        name,
-                        image_url,
-                        person_id
-                        ]
-                       )
+        rows.people.append((person_id, person.get('name'), person.get('image_path')))
+        rows.fingerprints.append((person_id, fingerprint_person(person)))
 
         location = person.get('current_location')
         if (location):
             location_id = location.get('id')
-
-            if (location_id not in processed_locations):
-                processed_locations.add(location_id)
-                logging.debug("Location #{}: {} ({})".format(
-                    location_id,
-                    location.get('name'),
-                    location.get('short_name')
-                ))
-                cursor.execute("INSERT INTO locations" +
-                               " (location_id, name, short_name)" +
-                               " VALUES (%s, %s, %s)" +
-                               " ON CONFLICT (location_id) DO NOTHING",
-                               [location_id,
-                                location.get('name'),
-                                location.get('short_name')
-                                ]
-                               )
-
-            cursor.execute("INSERT INTO location_affiliations" +
-                           " (person_id, location_id, affiliation_type)" +
-                           " VALUES (%s, %s, %s)" +
-                           " ON CONFLICT (person_id, affiliation_type)" +
-                           " DO UPDATE SET" +
-                           " location_id = %s" +
-                           " WHERE location_affiliations.person_id = %s",
-                           [person_id,
-                            location_id,
-                            "current_location",
-                            location_id,
-                            person_id
-                            ]
-                           )
+            rows.locations.append(
+                (location_id, location.get('name'), location.get('short_name')))
+            rows.affiliations.append((person_id, location_id, "current_location"))
 
         for stint in person['stints']:
             batch_id = None
@@ -131,84 +166,407 @@ def insert_people_data(cursor, people):
 
             if (batch):
                 batch_id = batch.get('id')
+                rows.batches.append((batch_id, batch.get('name'), batch.get('short_name')))
+
+            rows.stints.append((person_id,
+                                batch_id,
+                                stint.get('type'),
+                                stint.get('start_date'),
+                                stint.get('end_date'),
+                                stint.get('title'),
+                                ))
+
+    return rows
+
+
+class ProfileWriter:
+    """Writes batches of normalized profile rows with one multi-row upsert
+    per table, skipping locations and batches that an earlier batch in the
+    same run already wrote.
+
+    In incremental mode, people whose stored fingerprint matches their
+    profile are skipped entirely. Changed people are written in full,
+    stints are updated in place, and stints and current locations that
+    were removed from their profiles are deleted."""
+
+    def __init__(self, cursor, incremental=False):
+        self.cursor = cursor
+        self.incremental = incremental
+        self.people_count = 0
+        self.changed_count = 0
+        self.row_count = 0
+        self.processed_batches = set()
+        self.processed_locations = set()
+
+    def _upsert(self, sql, rows):
+        "Runs an INSERT with a single VALUES %s list covering every row."
+        if rows:
+            execute_values(self.cursor, sql, rows, page_size=len(rows))
+            self.row_count += self.cursor.rowcount
+
+    def _changed_people(self, rows):
+        "Returns the ids of people whose profile differs from the last sync."
+        self.cursor.execute("""SELECT person_id, fingerprint
+                               FROM person_fingerprints
+                               WHERE person_id = ANY(%s)""",
+                            [[person_id for person_id, _ in rows.fingerprints]])
+        stored = dict(self.cursor.fetchall())
+        return {person_id for person_id, fingerprint in rows.fingerprints
+                if stored.get(person_id) != fingerprint}
+
+    def _delete_stale(self, rows, person_ids):
+        "Deletes stints and current locations no longer in these profiles."
+        with_location = list({a[0] for a in rows.affiliations})
+        self.cursor.execute("""DELETE FROM location_affiliations
+                               WHERE person_id = ANY(%s)
+                                 AND affiliation_type = 'current_location'
+                                 AND NOT person_id = ANY(%s)""",
+                            [list(person_ids), with_location])
+        self.row_count += self.cursor.rowcount
+
+        self.cursor.execute("""DELETE FROM stints
+                               WHERE person_id = ANY(%s)
+                                 AND (person_id, start_date) NOT IN (
+                                   SELECT * FROM unnest(%s::INTEGER[], %s::DATE[])
+                                 )""",
+                            [list(person_ids),
+                             [s[0] for s in rows.stints],
+                             [s[3] for s in rows.stints]])
+        self.row_count += self.cursor.rowcount
+
+    def __call__(self, rows):
+        seen = len(rows.people)
+        if self.incremental:
+            changed = self._changed_people(rows)
+            rows = rows.only(changed)
+        self.people_count += seen
+        self.changed_count += len(rows.people)
+
+        # A statement may not upsert the same key twice, so keep the last
+        # version of each person and affiliation and the first of the rest,
+        # as the one-row-at-a-time inserts did.
+        people = {person[0]: person for person in rows.people}
+        affiliations = {(a[0], a[2]): a for a in rows.affiliations}
+        fingerprints = dict(rows.fingerprints)
+        locations = {}
+        for location in rows.locations:
+            if location[0] not in self.processed_locations:
+                locations.setdefault(location[0], location)
+        batches = {}
+        for batch in rows.batches:
+            if batch[0] not in self.processed_batches:
+                batches.setdefault(batch[0], batch)
+        stints = {}
+        for stint in rows.stints:
+            stints.setdefault((stint[0], stint[3]), stint)
+
+        logging.debug("Writing %s people, %s locations, %s batches, %s stints",
+                      len(people), len(locations), len(batches), len(stints))
+
+        self._upsert("INSERT INTO people" +
+                     " (person_id, name, image_url)" +
+                     " VALUES %s" +
+                     " ON CONFLICT (person_id) DO UPDATE SET" +
+                     " name = EXCLUDED.name," +
+                     " image_url = EXCLUDED.image_url",
+                     list(people.values()))
+
+        self._upsert("INSERT INTO locations" +
+                     " (location_id, name, short_name)" +
+                     " VALUES %s" +
+                     " ON CONFLICT (location_id) DO NOTHING",
+                     list(locations.values()))
+        self.processed_locations.update(locations)
+
+        self._upsert("INSERT INTO location_affiliations" +
+                     " (person_id, location_id, affiliation_type)" +
+                     " VALUES %s" +
+                     " ON CONFLICT (person_id, affiliation_type)" +
+                     " DO UPDATE SET" +
+                     " location_id = EXCLUDED.location_id",
+                     list(affiliations.values()))
+
+        self._upsert("INSERT INTO batches " +
+                     " (batch_id, name, short_name)" +
+                     " VALUES %s" +
+                     " ON CONFLICT (batch_id) DO NOTHING",
+                     list(batches.values()))
+        self.processed_batches.update(batches)
+
+        on_stint_conflict = " DO NOTHING"
+        if self.incremental:
+            on_stint_conflict = (" DO UPDATE SET" +
+                                 " batch_id = EXCLUDED.batch_id," +
+                                 " stint_type = EXCLUDED.stint_type," +
+                                 " end_date = EXCLUDED.end_date," +
+                                 " title = EXCLUDED.title")
+        self._upsert("INSERT INTO stints" +
+                     " (person_id, batch_id, stint_type," +
+                     "  start_date, end_date, title)" +
+                     " VALUES %s" +
+                     " ON CONFLICT (person_id, start_date)" +
+                     on_stint_conflict,
+                     list(stints.values()))
+
+        if self.incremental and people:
+            self._delete_stale(rows, people.keys())
+
+        if fingerprints:
+            execute_values(self.cursor,
+                           "INSERT INTO person_fingerprints" +
+                           " (person_id, fingerprint)" +
+                           " VALUES %s" +
+                           " ON CONFLICT (person_id) DO UPDATE SET" +
+                           " fingerprint = EXCLUDED.fingerprint," +
+                           " synced_at = now()",
+                           list(fingerprints.items()), page_size=len(fingerprints))
+
+    def log_totals(self):
+        logging.info('Inserted %s people', self.people_count)
+        if self.incremental:
+            logging.info('%s people changed since the last sync', self.changed_count)
+        logging.info('Inserted %s batches', len(self.processed_batches))
+        logging.info('Inserted %s locations', len(self.processed_locations))
+        logging.info('Touched %s rows', self.row_count)
+
 
-                if (batch_id not in processed_batches):
-                    logging.debug("  Batch {}, \"{}\" ({})".format(
-                        batch_id,
-                        batch.get('name'),
-                        batch.get('short_name')
-                    ))
-                    cursor.execute("INSERT INTO batches " +
-                                   " (batch_id, name, short_name)" +
-                                   " VALUES (%s, %s, %s)" +
-                                   " ON CONFLICT (batch_id) DO NOTHING",
-                                   [batch_id,
-                                    batch.get('name'),
-                                    batch.get('short_name')
-                                    ]
-                                   )
-                    processed_batches.add(batch_id)
-
-            logging.debug("  Stint: {}, Batch: {}, {} - {}".format(
-                stint.get('type'),
-                batch_id,
-                stint.get('start_date'),
-                stint.get('end_date')
-            ))
-            cursor.execute("INSERT INTO stints" +
-                           " (person_id, batch_id, stint_type," +
-                           "  start_date, end_date, title)" +
-                           " VALUES (%s, %s, %s, %s, %s, %s)" +
-                           " ON CONFLICT (person_id, start_date) DO NOTHING",
-                           [person_id,
-                            batch_id,
-                            stint.get('type'),
-                            stint.get('start_date'),
-                            stint.get('end_date'),
-                            stint.get('title'),
-                            ]
-                           )
-
-    logging.info('Inserted %s people', len(people))
-    logging.info('Inserted %s batches', len(processed_batches))
-    logging.info('Inserted %s locations', len(processed_locations))
-
-
-def process_rc_data(database_url, people):
+def insert_people_data(cursor, people):
+    writer = ProfileWriter(cursor)
+    writer(normalize_people(people))
+    writer.log_totals()
+
+
+def process_rc_data(database_url, pages, incremental=False):
+    """Stores RC profiles, given as an iterable of pages of profiles, and
+    geocodes any new locations. Pages are fetched, normalized and written
+    concurrently, so only a few pages are held in memory at a time.
+
+    In incremental mode only people whose profiles changed since the last
+    sync are written, and the aggregates are only refreshed if something
+    changed or the previous run was interrupted.
+
+    Returns how many records each phase handled and the seconds it took."""
     connection = psycopg2.connect(database_url)
     cursor = connection.cursor()
-
-    insert_people_data(cursor, people)
-    add_geolocation(cursor)
+    resuming = last_sync_interrupted(cursor)
+    run_id = start_sync_run(cursor, 'incremental' if incremental else 'full')
+
+    writer = ProfileWriter(cursor, incremental)
+    stages = Pipeline(pages, [('normalize', normalize_people), ('write', writer)]).run()
+    writer.log_totals()
+    phases = {stats.name: {'records': stats.records, 'seconds': stats.busy_seconds}
+              for stats in stages}
+    phases['write']['rows'] = writer.row_count
+
+    start = time.perf_counter()
+    geocoded = add_geolocation(cursor)
+    phases['geocode'] = {'records': geocoded, 'seconds': time.perf_counter() - start}
+
+    if writer.row_count or geocoded or resuming or not incremental:
+        start = time.perf_counter()
+        refresh_aggregates(cursor)
+        bump_dataset_version(cursor)
+        phases['refresh'] = {'seconds': time.perf_counter() - start}
+    finish_sync_run(cursor, run_id, writer, phases)
 
     connection.commit()
     cursor.close()
     connection.close()
     logging.info('Completed database update')
+    return phases
+
+
+def last_sync_interrupted(cursor):
+    """Returns whether the last update stopped before finishing, in which
+    case some of its changes may be committed without the aggregates
+    having been refreshed."""
+    cursor.execute("""SELECT finished_at IS NULL
+                      FROM sync_runs
+                      ORDER BY run_id DESC
+                      LIMIT 1""")
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def start_sync_run(cursor, mode):
+    "Records the start of an update and returns its run id."
+    cursor.execute("""INSERT INTO sync_runs (mode)
+                      VALUES (%s)
+                      RETURNING run_id""", [mode])
+    return cursor.fetchone()[0]
+
+
+def finish_sync_run(cursor, run_id, writer, phases):
+    "Records how much an update changed and how long each phase took."
+    cursor.execute("""UPDATE sync_runs
+                      SET finished_at = clock_timestamp(),
+                        people_seen = %s,
+                        people_changed = %s,
+                        rows_touched = %s,
+                        phases = %s
+                      WHERE run_id = %s""",
+                   [writer.people_count, writer.changed_count,
+                    writer.row_count, Json(phases), run_id])
+
+
+def refresh_aggregates(cursor):
+    """Recomputes the materialized location aggregates. The refresh runs
+    concurrently, so API reads are not blocked while it is in progress."""
+    logging.info('Refreshing location aggregates')
+
+    # The people aggregate joins the country populations, so refresh those first
+    cursor.execute(
+        "REFRESH MATERIALIZED VIEW CONCURRENTLY geolocations_popl_by_country_agg")
+    cursor.execute(
+        "REFRESH MATERIALIZED VIEW CONCURRENTLY geolocations_people_and_stints_agg")
+
+
+# How many dataset versions of location changes to keep; clients that
+# are further behind reload the whole dataset
+change_history_versions = int(get_env_var('CHANGE_HISTORY_VERSIONS', '100'))
+
+
+def bump_dataset_version(cursor):
+    """Marks the data served by the API as changed, so cached
+    responses built from an older version are rebuilt, and records
+    which locations the new version changed."""
+    cursor.execute("""UPDATE dataset_version
+                      SET version = version + 1,
+                        updated_at = now()
+                      RETURNING version""")
+    version = cursor.fetchone()[0]
+    changed = record_location_changes(cursor, version)
+    compact_location_changes(cursor, version - change_history_versions)
+    logging.info('Dataset version is now %s (%s locations changed)', version, changed)
+    return version
+
+
+def record_location_changes(cursor, version):
+    """Compares a hash of every aggregated location with the one stored
+    at the last version, records the locations that were added, changed
+    or removed as changes in `version`, and returns how many there were."""
+    cursor.execute("""WITH current AS (
+                        SELECT
+                          location_id,
+                          md5(concat_ws('|', location_name, type, lat, lng,
+                            city_count, total_population, person_list::TEXT))
+                            AS fingerprint
+                        FROM geolocations_people_and_stints_agg
+                      ), changed AS (
+                        INSERT INTO location_fingerprints (location_id, fingerprint)
+                        SELECT location_id, fingerprint FROM current
+                        ON CONFLICT (location_id) DO UPDATE
+                          SET fingerprint = EXCLUDED.fingerprint
+                          WHERE location_fingerprints.fingerprint <> EXCLUDED.fingerprint
+                        RETURNING location_id
+                      ), removed AS (
+                        DELETE FROM location_fingerprints f
+                        WHERE NOT EXISTS (
+                          SELECT 1 FROM current c WHERE c.location_id = f.location_id
+                        )
+                        RETURNING location_id
+                      )
+                      INSERT INTO location_changes (version, location_id)
+                      SELECT %(version)s, location_id FROM changed
+                      UNION
+                      SELECT %(version)s, location_id FROM removed""",
+                   {'version': version})
+    return cursor.rowcount
+
+
+def compact_location_changes(cursor, through_version):
+    """Forgets the location changes of every version up to `through_version`;
+    clients on those versions have to reload the whole dataset."""
+    cursor.execute("""DELETE FROM location_changes
+                      WHERE version <= %s""", [through_version])
+    cursor.execute("""UPDATE dataset_version
+                      SET compacted_through = GREATEST(compacted_through, %s)""",
+                   [through_version])
 
 
 def add_geolocation(cursor):
+    """Geocodes every location without geo data and returns how many were
+    stored. Each location is committed as soon as it is stored, so an
+    interrupted run picks up where it stopped the next time it runs.
+
+    Cached and offline results are stored straight away; the rest are
+    looked up by a pool of GEOCODE_WORKERS threads, which together stay
+    within the GeoNames rate limit. Locations that make the same query
+    share one request."""
+    connection = cursor.connection
     locations = get_locations_from_db(cursor)
-    no_geo_count = len(locations)
+    logging.info('Retrieved %s locations without geo data', len(locations))
 
-    logging.info('Retrieved %s locations without geo data', no_geo_count)
-
-    if (no_geo_count > 0):
-        logging.info(
-            'Adding geolocation data... (this will take a few minutes)')
+    # Everything written so far is kept even if geocoding is interrupted
+    connection.commit()
 
+    progress = Progress('Geocoding', len(locations))
+    geocoded = 0
+    pending = {}    # future -> (cache key, request)
+    waiting = {}    # cache key -> the parsed locations waiting for it
+    pool = ThreadPoolExecutor(max_workers=geocode_workers,
+                              thread_name_prefix='geocode')
+    try:
         for location in locations:
-            geo = lookup_geodata(cursor, location)
-            insert_geo_data(cursor, geo)
+            parsed = parse_location(location)
+            request = geonames_request(parsed)
+            result = offline_query(parsed)
+            key = geocode_cache_key(*request)
+            if (result is None and key in waiting):
+                waiting[key].append(parsed)
+                continue
+            if (result is None):
+                result = get_cached_geocode(cursor, *key)
+            if (result is None):
+                pending[pool.submit(fetch_geonames, *request)] = (key, request)
+                waiting[key] = [parsed]
+                continue
+
+            geocoded += store_geodata(cursor, parsed, result)
+            progress.advance()
+
+        for future in as_completed(pending):
+            key, request = pending[future]
+            try:
+                result = future.result()
+            except GeocodeQuotaExceeded as e:
+                logging.error('Stopping geocoding: %s', e)
+                break
+            except GeocodeError as e:
+                for parsed in waiting[key]:
+                    logging.warning('Could not geocode %s, leaving it for the next run: %s',
+                                    parsed['full_name'], e)
+                    progress.advance()
+            else:
+                cache_geocode(cursor, *key, result)
+                for parsed in waiting[key]:
+                    geocoded += store_geodata(cursor, parsed, result)
+                    progress.advance()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+    logging.info('Inserted %s locations', geocoded)
+    reconcile_duplicates(cursor)
+    return geocoded
 
-        logging.info('Inserted %s locations', no_geo_count)
 
-    reconcile_duplicates(cursor)
+def store_geodata(cursor, parsed_location, result):
+    "Stores and commits one location's geocode; returns 1 if stored, else 0."
+    try:
+        geo = add_geonames_result(parsed_location, result)
+    except (KeyError, TypeError):
+        logging.warning('No geocode found for %s', parsed_location['full_name'])
+        return 0
+    insert_geo_data(cursor, geo)
+    cursor.connection.commit()
+    return 1
 
 
 def lookup_geodata(cursor, location):
     parsed = parse_location(location)
-    result = geonames_query(parsed)
+    result = offline_query(parsed)
+    if (result is None):
+        result = geonames_query(parsed, cursor)
     geo = add_geonames_result(parsed, result)
     return geo
 
@@ -234,10 +592,53 @@ def get_locations_from_db(cursor):
 
 
 geonames_username = get_env_var('GEONAMES_USERNAME')
+geonames_url = get_env_var('GEONAMES_URL', 'http://api.geonames.org/searchJSON')
+
+# With GEOCODER=offline, locations are resolved from a prebuilt GeoNames
+# dump index (see offline_geocoder.py) before falling back to the web service
+offline_geocoder = None
+if (get_env_var('GEOCODER', 'geonames') == 'offline'):
+    offline_geocoder = OfflineGeocoder(get_env_var('GEONAMES_INDEX', 'geonames.idx'))
+
+
+def offline_query(location):
+    "Returns the offline index's result for a parsed location, or None."
+    if (offline_geocoder is None):
+        return None
+
+    # GeoNames uses the two-letter state code as the admin1 code for US states
+    admin1_code = get_state_code(location["state_name"]) if location["state_name"] else None
+    result = offline_geocoder.resolve(location, admin1_code)
+    if (result is None):
+        logging.info("No offline geocode for %s", location["full_name"])
+    return result
+
+
+class GeocodeError(Exception):
+    "Raised when GeoNames can't answer a query, even after retrying."
+
+
+class GeocodeQuotaExceeded(GeocodeError):
+    "Raised when the GeoNames daily or weekly request quota is used up."
 
 
-def geonames_query(location):
-    time.sleep(2.5)  # Slow down requests to avoid timeout (< 1/sec)
+# GeoNames error codes: 18 and 20 mean the daily or weekly quota is used
+# up; 13 (database timeout), 19 (hourly limit) and 22 (server overloaded)
+# are worth retrying after a pause.
+GEONAMES_QUOTA_ERRORS = {18, 20}
+GEONAMES_RETRY_ERRORS = {13, 19, 22}
+
+# Every GeoNames request made by this process draws from one token bucket,
+# so concurrent workers together stay under the account's rate limit
+geonames_limiter = TokenBucket(float(get_env_var('GEONAMES_RATE', '0.4')),
+                               int(get_env_var('GEONAMES_BURST', '1')))
+geocode_workers = int(get_env_var('GEOCODE_WORKERS', '2'))
+geocode_retries = 4
+
+
+def geonames_request(location):
+    """Returns the GeoNames search query, feature classes and row limit
+    for a parsed location."""
 
     # Enhance query with all named parts of location, if present
     query = location["base_name"]
@@ -247,9 +648,129 @@ def geonames_query(location):
         query = query + " " + location["country_name"]
 
     # Limit results to city and country feature types
-    feature_classes = ['A', 'P']
-
-    return geocoder.geonames(query, key=geonames_username, featureClass=feature_classes, maxRows=1).json["raw"]
+    return query, ['A', 'P'], 1
+
+
+def geocode_cache_key(query, feature_classes, max_rows):
+    return normalize_geocode_query(query), ",".join(sorted(feature_classes)), max_rows
+
+
+def geonames_query(location, cursor=None):
+    """Returns the top GeoNames search result for a parsed location.
+    When a cursor is given, results are read from and saved to the
+    geocode cache, so each distinct query only reaches GeoNames once."""
+    request = geonames_request(location)
+    key = geocode_cache_key(*request)
+    if (cursor):
+        cached = get_cached_geocode(cursor, *key)
+        if (cached is not None):
+            return cached
+
+    result = fetch_geonames(*request)
+
+    if (cursor):
+        cache_geocode(cursor, *key, result)
+    return result
+
+
+def fetch_geonames(query, feature_classes, max_rows):
+    """Returns GeoNames' raw top result for a query, or {} if it has none.
+    Waits for the shared rate limiter before each request, and retries
+    network errors and transient GeoNames errors with jittered backoff."""
+    for attempt in range(geocode_retries + 1):
+        geonames_limiter.acquire()
+        start = time.perf_counter()
+        response = geocoder.geonames(query, key=geonames_username, url=geonames_url,
+                                     featureClass=feature_classes, maxRows=max_rows)
+        http_status = response.status_code if isinstance(response.status_code, int) else 'error'
+        metrics.upstream_request_seconds.observe(
+            ('GeoNames', str(http_status)), time.perf_counter() - start)
+        if (not response.error):
+            return (response.json or {}).get("raw", {})
+
+        status = geonames_status(response)
+        if (status.get("value") in GEONAMES_QUOTA_ERRORS):
+            raise GeocodeQuotaExceeded(status.get("message"))
+        transient = status.get("value") in GEONAMES_RETRY_ERRORS or \
+            not isinstance(response.status_code, int) or response.status_code >= 500
+        if (not transient or attempt == geocode_retries):
+            raise GeocodeError(f"'{query}': {response.error}")
+
+        delay = random.uniform(0, min(60.0, 2.0 * 2 ** attempt))
+        logging.warning("GeoNames error for '%s' (%s), retrying in %.1fs",
+                        query, response.error, delay)
+        time.sleep(delay)
+
+
+def geonames_status(response):
+    "Returns the status object of a GeoNames error response, if it has one."
+    try:
+        return response.response.json().get("status") or {}
+    except (AttributeError, ValueError):
+        return {}
+
+
+def normalize_geocode_query(query):
+    "Returns the geocode cache key for a query: lowercase, single-spaced."
+    return " ".join(query.split()).casefold()
+
+
+def get_cached_geocode(cursor, query, feature_classes, max_rows):
+    "Returns the cached GeoNames result for a query, or None."
+    cursor.execute("""SELECT result
+                      FROM geocode_cache
+                      WHERE query = %s
+                        AND feature_classes = %s
+                        AND max_rows = %s""",
+                   [query, feature_classes, max_rows])
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def cache_geocode(cursor, query, feature_classes, max_rows, result):
+    logging.debug("Cache GeoNames result for '%s'", query)
+    cursor.execute("INSERT INTO geocode_cache" +
+                   " (query, feature_classes, max_rows, result)" +
+                   " VALUES (%s, %s, %s, %s)" +
+                   " ON CONFLICT (query, feature_classes, max_rows) DO UPDATE SET" +
+                   " result = EXCLUDED.result," +
+                   " fetched_at = now()",
+                   [query, feature_classes, max_rows, Json(result)])
+
+
+def export_geocode_cache(cursor, file):
+    """Writes every cached GeoNames result to a file, one JSON object per
+    line, so another database can be seeded without calling GeoNames."""
+    cursor.execute("""SELECT query, feature_classes, max_rows, result
+                      FROM geocode_cache
+                      ORDER BY query, feature_classes, max_rows""")
+    count = 0
+    for query, feature_classes, max_rows, result in cursor:
+        file.write(json.dumps({
+            'query': query,
+            'feature_classes': feature_classes,
+            'max_rows': max_rows,
+            'result': result,
+        }) + "\n")
+        count += 1
+
+    logging.info('Exported %s cached geocodes', count)
+
+
+def import_geocode_cache(cursor, file):
+    "Loads cached GeoNames results written by export_geocode_cache."
+    entries = [json.loads(line) for line in file if line.strip()]
+    execute_values(cursor,
+                   "INSERT INTO geocode_cache" +
+                   " (query, feature_classes, max_rows, result)" +
+                   " VALUES %s" +
+                   " ON CONFLICT (query, feature_classes, max_rows) DO NOTHING",
+                   [(normalize_geocode_query(e['query']),
+                     e['feature_classes'],
+                     e['max_rows'],
+                     Json(e['result'])) for e in entries])
+
+    logging.info('Imported %s cached geocodes', len(entries))
 
 
 def get_state_name(state_code):
@@ -260,6 +781,13 @@ def get_state_name(state_code):
     return usStates[state_code]
 
 
+def get_state_code(state_name):
+    with open('src/usStates.json') as json_file:
+        usStates = json.load(json_file)
+
+    return next((code for code, name in usStates.items() if name == state_name), None)
+
+
 def parse_location(location):
     location_id = location.get('location_id') if location.get(
         'location_id') else location.get('id')
@@ -284,10 +812,8 @@ def parse_location(location):
 
 
 def add_geonames_result(parsed_location, geonames_result):
-    logging.debug("Combining geo results. Parsed: {}\n GeoNames: {}".format(
-        parsed_location,
-        geonames_result
-    ))
+    logging.debug("Combining geo results. Parsed: %s\n GeoNames: %s",
+                  parsed_location, geonames_result)
 
     return {
         'location_id': parsed_location['location_id'],
@@ -303,17 +829,16 @@ def add_geonames_result(parsed_location, geonames_result):
 
 
 def insert_geo_data(cursor, location):
-    logging.info("Insert GeoLocation #{}: {} ({}), SubDiv: {} ({}), Country: {} ({}), ({},{})".format(
-        location.get('location_id'),
-        location.get('name'),
-        location.get('type'),
-        location.get('subdivision_derived'),
-        location.get('subdivision_code'),
-        location.get('country_name'),
-        location.get('country_code'),
-        location.get('lat'),
-        location.get('lng'),
-    ))
+    logging.info("Insert GeoLocation #%s: %s (%s), SubDiv: %s (%s), Country: %s (%s), (%s,%s)",
+                 location.get('location_id'),
+                 location.get('name'),
+                 location.get('type'),
+                 location.get('subdivision_derived'),
+                 location.get('subdivision_code'),
+                 location.get('country_name'),
+                 location.get('country_code'),
+                 location.get('lat'),
+                 location.get('lng'))
     cursor.execute("INSERT INTO geolocations" +
                    " (location_id, name, type," +
                    " subdivision_derived, subdivision_code," +
@@ -334,12 +859,11 @@ def insert_geo_data(cursor, location):
 
 
 def insert_alias(cursor, location, preferred_location):
-    logging.info("Insert Alias #{} {} for Location #{} {}".format(
-        location.get('location_id'),
-        location.get('name'),
-        preferred_location.get('location_id'),
-        preferred_location.get('name')
-    ))
+    logging.info("Insert Alias #%s %s for Location #%s %s",
+                 location.get('location_id'),
+                 location.get('name'),
+                 preferred_location.get('location_id'),
+                 preferred_location.get('name'))
 
     cursor.execute("INSERT INTO location_aliases" +
                    " (location_id, preferred_location_id)" +
@@ -350,84 +874,198 @@ def insert_alias(cursor, location, preferred_location):
 
 
 def reconcile_duplicates(cursor):
-    logging.info('Beginning reconciliation of duplicate locations')
-
-    # Find locations where lat/lng count is greater than one
-    # Get counts for populations of RCers at each location
-    for counts in get_location_counts(cursor):
-
-        # Find the location with the greatest number of RCers
-        preferred_index = None
-        max_count = 0
-
-        for i, loc in enumerate(counts):
-            pop = loc["population"]  # pop can be null
-
-            if (pop and pop > max_count):
-                max_count = pop
-                preferred_index = i
+    """Aliases duplicate locations, whose coordinates are within the
+    coordinate tolerance of each other, to the one with the most RCers,
+    and moves everyone affiliated with an alias to its preferred location.
 
-        dupe_locs = counts
-        preferred_loc = dupe_locs.pop(preferred_index)
-
-        for loc in dupe_locs:
-            # Add aliases for duplicate locations to point to preferred
-            insert_alias(cursor, loc, preferred_loc)
+    Only geolocations added since the last reconciliation are compared
+    with their neighbours, and the aliases and affiliations of every
+    duplicate group are written together in a few statements."""
+    logging.info('Beginning reconciliation of duplicate locations')
 
-            # Update all people pointing to old location with new in location_affiliations
-            update_location_affiliations(cursor, loc, preferred_loc)
+    # Profiles can point people at aliased locations again, so move them
+    # first to count populations the way the map shows them
+    moved = move_aliased_affiliations(cursor)
 
-    logging.info('Duplicate locations reassigned')
+    aliases = []
+    for counts in get_location_counts(cursor):
+        # Prefer the location with the greatest number of RCers, never an alias
+        preferred = max(counts, key=lambda loc: (
+            not loc['aliased'], loc['population'] or 0, -loc['location_id']))
+        aliases.extend((loc['location_id'], preferred['location_id'])
+                       for loc in counts if loc is not preferred)
+
+    if aliases:
+        execute_values(cursor,
+                       "INSERT INTO location_aliases" +
+                       " (location_id, preferred_location_id)" +
+                       " VALUES %s" +
+                       " ON CONFLICT (location_id) DO NOTHING",
+                       aliases, page_size=len(aliases))
+        logging.info('Inserted %s aliases', cursor.rowcount)
+
+        # A new preferred location may replace an old one that others
+        # were aliased to; point those straight at the new one
+        cursor.execute("""UPDATE location_aliases a
+                          SET preferred_location_id = b.preferred_location_id
+                          FROM location_aliases b
+                          WHERE a.preferred_location_id = b.location_id""")
+        moved += move_aliased_affiliations(cursor)
+
+    cursor.execute("""UPDATE geolocations
+                      SET reconciled = TRUE
+                      WHERE NOT reconciled""")
+    logging.info('Duplicate locations reassigned (%s affiliations moved)', moved)
+
+
+def move_aliased_affiliations(cursor):
+    """Points every affiliation with an aliased location at its preferred
+    location instead, and returns how many were moved."""
+    cursor.execute("""UPDATE location_affiliations la
+                      SET location_id = a.preferred_location_id
+                      FROM location_aliases a
+                      WHERE la.location_id = a.location_id""")
+    return cursor.rowcount
+
+
+# Geocodes whose lat and lng are both within this many degrees of each
+# other are taken to be the same place
+coordinate_tolerance = float(get_env_var('COORDINATE_TOLERANCE', '0.001'))
+
+# Selects the geolocations b within %(tolerance)s degrees of the point
+# ({lat}, {lng}), scanning only the index ranges of the grid cells (see
+# geo_grid_cell in schema.sql) that the tolerance box overlaps. The box
+# is also tried a full turn east and west, so points either side of the
+# antimeridian (+180/-180 degrees) match; wrap.degrees is the shift that
+# brings b next to the point, for measuring the distance between them.
+NEARBY_GEOLOCATIONS = """generate_series(
+        floor(({lat} - %(tolerance)s + 90) * 100)::BIGINT,
+        floor(({lat} + %(tolerance)s + 90) * 100)::BIGINT) AS cell_row
+    CROSS JOIN (VALUES (-360.0), (0.0), (360.0)) AS wrap(degrees)
+    INNER JOIN geolocations b
+      ON b.grid_cell BETWEEN
+        cell_row * 100000 + floor(({lng} + wrap.degrees - %(tolerance)s + 180) * 100)::BIGINT
+        AND cell_row * 100000 + floor(({lng} + wrap.degrees + %(tolerance)s + 180) * 100)::BIGINT
+      AND abs(b.lat - {lat}) <= %(tolerance)s
+      AND abs(b.lng - ({lng} + wrap.degrees)) <= %(tolerance)s"""
+
+
+def find_nearby_location(cursor, lat, lng, location_id):
+    """Returns the closest geolocation, other than location_id and locations
+    aliased to another one, within the coordinate tolerance of (lat, lng),
+    or None."""
+    cursor.execute("""SELECT
+                        b.location_id,
+                        b.name
+                      FROM """ +
+                   NEARBY_GEOLOCATIONS.format(lat='%(lat)s::DOUBLE PRECISION',
+                                              lng='%(lng)s::DOUBLE PRECISION') + """
+                      WHERE b.location_id <> %(location_id)s
+                        AND NOT EXISTS (
+                          SELECT FROM location_aliases a
+                          WHERE a.location_id = b.location_id
+                        )
+                      ORDER BY (b.lat - %(lat)s) ^ 2 + (b.lng - %(lng)s - wrap.degrees) ^ 2
+                      LIMIT 1""",
+                   {'lat': float(lat), 'lng': float(lng),
+                    'tolerance': coordinate_tolerance, 'location_id': location_id})
+    row = cursor.fetchone()
+    return {'location_id': row[0], 'location_name': row[1]} if row else None
 
 
 def get_location_counts(cursor):
-    """Returns then lat/lng values of duplicate locations with their population counts."""
+    """Returns the groups of duplicate locations that include a geolocation
+    added since the last reconciliation, with their population counts and
+    whether they are already aliased to another location."""
     cursor.execute("""SELECT
-                        json_agg(
-                            json_build_object(
-                                'location_id', g.location_id, 
-                                'name', g.name, 
-                                'population', population
-                            )
-                        ) AS counts
+                        a.location_id,
+                        b.location_id,
+                        alias.preferred_location_id
+                      FROM geolocations a
+                      CROSS JOIN LATERAL """ +
+                   NEARBY_GEOLOCATIONS.format(lat='a.lat', lng='a.lng') + """
+                      LEFT JOIN location_aliases alias
+                        ON alias.location_id = b.location_id
+                      WHERE NOT a.reconciled
+                        AND a.location_id <> b.location_id""",
+                   {'tolerance': coordinate_tolerance})
+
+    # Group chains of nearby locations together, along with the location
+    # any of them is already aliased to
+    groups = {}
+    for ids in cursor.fetchall():
+        group = set()
+        for location_id in ids:
+            if location_id is not None:
+                group |= groups.get(location_id, {location_id})
+        for location_id in group:
+            groups[location_id] = group
+
+    duplicates = list({id(group): group for group in groups.values()}.values())
+    if not duplicates:
+        return []
+
+    cursor.execute("""SELECT
+                        g.location_id,
+                        g.name,
+                        p.population,
+                        a.location_id IS NOT NULL AS aliased
                       FROM geolocations g
                       LEFT JOIN (
-                          SELECT 
-                            location_id, 
-                            COALESCE(COUNT(person_id), 0) AS population
+                          SELECT
+                            location_id,
+                            COUNT(person_id) AS population
                           FROM location_affiliations
+                          WHERE location_id = ANY(%(ids)s)
                           GROUP BY location_id
                         ) AS p
                       ON g.location_id = p.location_id
-                      GROUP BY lat, lng HAVING count(*) > 1""")
+                      LEFT JOIN location_aliases a
+                        ON a.location_id = g.location_id
+                      WHERE g.location_id = ANY(%(ids)s)""",
+                   {'ids': list(groups)})
+    locations = {x[0]: {'location_id': x[0], 'name': x[1],
+                        'population': x[2], 'aliased': x[3]}
+                 for x in cursor.fetchall()}
 
-    return [x[0] for x in cursor.fetchall()]
-
-
-def update_location_affiliations(cursor, old_location, new_location):
-    logging.info("Update Affiliations From #{} {} to New Location #{} {}".format(
-        old_location.get('location_id'),
-        old_location.get('name'),
-        new_location.get('location_id'),
-        new_location.get('name')
-    ))
-
-    """Updates all rows with the given old_location id to the new_location id in the locations_affiliations table."""
-    cursor.execute("""UPDATE location_affiliations
-                      SET location_id = %s
-                      WHERE location_id = %s""",
-                   [new_location["location_id"], old_location["location_id"]])
+    groups = [[locations[location_id] for location_id in sorted(group)
+               if location_id in locations] for group in duplicates]
+    return [group for group in groups if len(group) > 1]
 
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only write people whose profiles changed since the last run')
+    parser.add_argument('--export-geocode-cache', metavar='FILE',
+                        help='save cached GeoNames results to FILE and exit')
+    parser.add_argument('--import-geocode-cache', metavar='FILE',
+                        help='load cached GeoNames results from FILE and exit')
+    args = parser.parse_args()
+
     database_url = get_env_var('DATABASE_URL')
+
+    if args.export_geocode_cache or args.import_geocode_cache:
+        connection = psycopg2.connect(database_url)
+        cursor = connection.cursor()
+        if args.export_geocode_cache:
+            with open(args.export_geocode_cache, 'w') as cache_file:
+                export_geocode_cache(cursor, cache_file)
+        if args.import_geocode_cache:
+            with open(args.import_geocode_cache) as cache_file:
+                import_geocode_cache(cursor, cache_file)
+        connection.commit()
+        connection.close()
+        sys.exit()
+
     token = get_env_var('RC_API_ACCESS_TOKEN')
+    concurrency = int(get_env_var('RC_API_CONCURRENCY', '4'))
 
     logging.info('Starting World Map database update')
     logging.info(
         'Pulling RC API profile data (this may take a few seconds)...')
-    people = get_people(token)
-    logging.info('Found %s people', len(people))
-    process_rc_data(database_url, people)
+    pages = get_profile_pages(rc_api_client(token, concurrency),
+                              concurrency=concurrency)
+    process_rc_data(database_url, pages, args.incremental)
     logging.info('Geolocation completed.')
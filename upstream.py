@@ -0,0 +1,207 @@
+"""
+Shared HTTP client for the upstream APIs used by the Recurse World Map
+"""
+
+# Copyright (C) 2019 Jaryn Colbert <jaryn.colbert@gmail.com>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from email.utils import parsedate_to_datetime
+from urllib.parse import urljoin
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import metrics
+
+RC_API_URL = 'https://www.recurse.com/api/v1/'
+
+# Responses worth retrying: rate limiting and transient gateway errors
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    "Raised without calling upstream while its circuit breaker is open."
+
+
+class CircuitBreaker:
+    """Stops calling an upstream after `failure_threshold` consecutive
+    failures. After `reset_timeout` seconds one trial call is let through,
+    and its outcome decides whether the circuit closes again."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        "Returns whether a call may go ahead."
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            # Only the single trial call is allowed while half-open
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or \
+                    self._failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logging.warning('Opening circuit after %s failures',
+                                    self._failures)
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+class TokenBucket:
+    """Limits calls to an average of `rate` per second, allowing bursts of
+    up to `burst` calls. One bucket is shared by every thread calling the
+    same upstream, so together they stay within its quota."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        "Waits until a call is allowed, and returns how long that took."
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst,
+                               self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            # Reserve a token even if it isn't there yet; the balance going
+            # negative queues up later callers behind this one.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class UpstreamClient:
+    """A keep-alive HTTP client for one upstream API.
+
+    GET requests have connect and read timeouts, are retried with jittered
+    exponential backoff on connection errors and retryable statuses
+    (honoring Retry-After), and fail fast with UpstreamUnavailable while
+    the circuit breaker is open."""
+
+    def __init__(self, base_url, token=None, name=None, timeout=(3.05, 10.0),
+                 retries=3, backoff=0.5, max_backoff=10.0, pool_size=10,
+                 breaker=None):
+        # urljoin() replaces the last segment of a base URL without a
+        # trailing slash, e.g. /api/v1 + profiles -> /api/profiles
+        self.base_url = base_url if base_url.endswith('/') else base_url + '/'
+        self.name = name or base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = breaker or CircuitBreaker()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if token:
+            self.session.headers.update({'Authorization': f'Bearer {token}'})
+
+    def _delay(self, attempt, response=None):
+        "Returns how long to wait before the next attempt."
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0.0), self.max_backoff)
+
+        # "Full jitter": spread retries out so clients don't retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def get(self, path, params=None, headers=None, timeout=None):
+        """Returns the response for a GET request to `path`, relative to the
+        base URL. Raises requests.HTTPError for unsuccessful statuses."""
+        url = urljoin(self.base_url, path)
+
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                metrics.upstream_rejected.inc((self.name,))
+                raise UpstreamUnavailable(f"{self.name} is unavailable")
+
+            start = time.perf_counter()
+            try:
+                response = self.session.get(url, params=params, headers=headers,
+                                            timeout=timeout or self.timeout)
+            except requests.exceptions.RequestException as e:
+                # Every failed call counts against the breaker, so a failed
+                # half-open trial reopens it rather than leaving it half-open
+                metrics.upstream_request_seconds.observe(
+                    (self.name, type(e).__name__), time.perf_counter() - start)
+                self.breaker.record_failure()
+                retryable = isinstance(e, (requests.exceptions.ConnectionError,
+                                           requests.exceptions.Timeout))
+                if not retryable or attempt == self.retries:
+                    raise
+                logging.warning('%s: %s, retrying', self.name, e)
+                response = None
+            else:
+                metrics.upstream_request_seconds.observe(
+                    (self.name, str(response.status_code)), time.perf_counter() - start)
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code >= 500:
+                        self.breaker.record_failure()
+                    else:
+                        self.breaker.record_success()
+                    response.raise_for_status()
+                    return response
+
+                self.breaker.record_failure()
+                if attempt == self.retries:
+                    response.raise_for_status()
+                logging.warning('%s: %s from %s, retrying', self.name,
+                                response.status_code, url)
+
+            metrics.upstream_retries.inc((self.name,))
+            time.sleep(self._delay(attempt, response))
+
+    def get_json(self, path, params=None, headers=None, timeout=None):
+        "Returns the decoded JSON body of a GET request to `path`."
+        return self.get(path, params=params, headers=headers, timeout=timeout).json()
@@ -17,16 +17,38 @@ Recurse World Map back-end
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+from datetime import date
 from itertools import groupby
+import base64
+import hmac
+import json
 import logging
+import math
+import os
+import time
 from functools import wraps
-import requests
-from flask import Flask, jsonify, redirect, request, send_from_directory, session, url_for
+from flask import (Flask, Response, g, jsonify, redirect, request, send_from_directory,
+                   session, url_for)
 from flask_cors import CORS
 from authlib.integrations.flask_client import OAuth
 from werkzeug.exceptions import HTTPException
-import psycopg2
-from update_data import get_env_var, lookup_geodata, insert_geo_data, insert_alias
+import requests
+from cache import EncodedPayload, TTLCache, VersionedCache
+from clusters import ClusterIndex, parse_bbox
+import columnar
+from db import ConnectionPool, PoolTimeout
+from jobs import BackgroundJobs
+import metrics
+from nearby import MAX_DISTANCE_KM, SpatialIndex
+from search import LocationSearchIndex, normalize
+from upstream import RC_API_URL, UpstreamClient, UpstreamUnavailable
+from update_data import (get_env_var, lookup_geodata, insert_geo_data, insert_alias,
+                         find_nearby_location, bump_dataset_version, refresh_aggregates)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 # pylint: disable=invalid-name
@@ -45,8 +67,140 @@ rc = OAuth(app).register(
     client_secret=get_env_var('CLIENT_SECRET'),
 )
 
-connection = psycopg2.connect(get_env_var('DATABASE_URL'))
+db_pool = ConnectionPool(
+    get_env_var('DATABASE_URL'),
+    min_size=int(get_env_var('DB_POOL_MIN_SIZE', '1')),
+    max_size=int(get_env_var('DB_POOL_MAX_SIZE', '10')),
+    timeout=float(get_env_var('DB_POOL_TIMEOUT', '10')),
+    cursor_factory=metrics.TimedCursor,
+)
 token = get_env_var('RC_API_ACCESS_TOKEN')
+# Calls made while handling a request retry once, briefly, so that even
+# two timed-out attempts finish well within GUNICORN_TIMEOUT
+rc_api = UpstreamClient(get_env_var('RC_API_URL', RC_API_URL), token=token,
+                        name='RC API', timeout=(3.05, 10.0),
+                        retries=1, backoff=0.25, max_backoff=2.0,
+                        pool_size=int(get_env_var('RC_API_POOL_SIZE', '10')))
+
+# Encoded /api/locations/all responses, rebuilt when the dataset version changes
+payload_cache = VersionedCache()
+# In-memory location indexes, rebuilt the same way
+index_cache = VersionedCache()
+# Locations being geocoded in the background; see claim_geocode_job
+geocode_jobs = BackgroundJobs(
+    max_workers=int(get_env_var('GEOCODE_JOB_WORKERS', '2')), name='geocode')
+# Seconds before a pending job whose worker has gone quiet can be claimed again
+geocode_job_timeout = float(get_env_var('GEOCODE_JOB_TIMEOUT', '300'))
+# RC API location suggestions for queries the local index could not answer
+suggestion_cache = TTLCache(
+    maxsize=int(get_env_var('SEARCH_CACHE_SIZE', '2048')),
+    ttl=float(get_env_var('SEARCH_CACHE_TTL', '86400')),
+)
+
+
+@app.errorhandler(PoolTimeout)
+def database_busy(error):
+    "Ask the client to retry when every pooled connection is checked out"
+    logging.warning('Database pool exhausted: %s', error)
+    return (jsonify({
+        'message': 'Service Unavailable',
+    }), 503, {'Retry-After': '1'})
+
+
+@app.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(error):
+    "Fail fast while the RC API is known to be down"
+    logging.warning('Upstream unavailable: %s', error)
+    return (jsonify({
+        'message': 'Service Unavailable',
+    }), 503, {'Retry-After': str(int(rc_api.breaker.reset_timeout))})
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    "Time the request in worldmap_http_request_seconds, labelled by route"
+    started = g.pop('request_started', None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.http_request_seconds.observe(
+            (route, request.method, str(response.status_code)),
+            time.perf_counter() - started)
+    return response
+
+
+# Bearer token Prometheus sends for /metrics; without one, only requests
+# from this host are answered
+metrics_token = os.getenv('METRICS_TOKEN')
+# With several worker processes, each saves its metrics in this directory
+# so that any of them can report the totals (see gunicorn.conf.py)
+if os.getenv('METRICS_DIR'):
+    metrics.registry.share(os.getenv('METRICS_DIR'))
+
+
+def metrics_request_allowed():
+    if metrics_token:
+        return hmac.compare_digest(request.headers.get('Authorization', ''),
+                                   f'Bearer {metrics_token}')
+    return request.remote_addr in ('127.0.0.1', '::1')
+
+
+@app.errorhandler(requests.exceptions.RequestException)
+def upstream_failed(error):
+    "Report an RC API call that failed even after retrying"
+    logging.warning('Upstream request failed: %s', error)
+    return (jsonify({
+        'message': 'Bad Gateway',
+        'error': 'The Recurse Center API could not be reached',
+    }), 502)
+
+
+@app.route('/metrics')
+def get_metrics():
+    "Get request, query, upstream and ingest timings for Prometheus"
+    if not metrics_request_allowed():
+        return (jsonify({
+            'message': 'Access Denied',
+        }), 403)
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def get_latest_sync_runs():
+    """Returns the phases of the latest finished update of each mode,
+    read once per scrape."""
+    if 'sync_runs' not in g:
+        with db_pool.connection() as connection:
+            cursor = connection.cursor()
+            cursor.execute("""SELECT DISTINCT ON (mode)
+                                mode,
+                                phases
+                              FROM sync_runs
+                              WHERE finished_at IS NOT NULL
+                                AND phases IS NOT NULL
+                              ORDER BY mode, finished_at DESC""")
+            g.sync_runs = cursor.fetchall()
+            cursor.close()
+    return g.sync_runs
+
+
+def collect_ingest_phases(field):
+    return lambda: {(mode, phase): stats[field]
+                    for mode, phases in get_latest_sync_runs()
+                    for phase, stats in phases.items() if field in stats}
+
+
+metrics.registry.gauge(
+    'worldmap_ingest_phase_seconds',
+    'Seconds each phase of the latest update_data.py run took.',
+    ('mode', 'phase'), collect_ingest_phases('seconds'))
+metrics.registry.gauge(
+    'worldmap_ingest_phase_records',
+    'Records each phase of the latest update_data.py run handled.',
+    ('mode', 'phase'), collect_ingest_phases('records'))
 
 
 @app.route('/')
@@ -107,14 +261,7 @@ def auth_recurse_callback():
 def get_rc_profile():
     "Return the RC API information for the currently logged in user"
 
-    headers = {'Authorization': f'Bearer {token}'}
-    url = 'https://www.recurse.com/api/v1/profiles/me'
-
-    r = requests.get(url, headers=headers)
-    if r.status_code != requests.codes['ok']:
-        r.raise_for_status()
-
-    me = r.json()
+    me = rc_api.get_json('profiles/me')
     session['recurse_user_id'] = me.get('id', '')
     session['recurse_user_name'] = me.get('name', '')
     session['recurse_user_image'] = me.get('image_path', '')
@@ -144,11 +291,11 @@ def needs_authorization(route):
 # @app.route('/api/locations/all')
 @needs_authorization
 def get_all_rc_locations():
-    cursor = connection.cursor()
-
     """Returns all locations in the database
     with their geolocation data."""
-    cursor.execute("""SELECT
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""SELECT
                         location_id,
                         name,
                         lat,
@@ -160,14 +307,14 @@ def get_all_rc_locations():
                           WHERE location_id = geolocations.location_id
                         )
                       ORDER BY location_id""")
-    locations = [{
-        'location_id': x[0],
-        'location_name': x[1],
-        'lat': x[2],
-        'lng': x[3],
-        'has_rc_people': True
-    } for x in cursor.fetchall()]
-    cursor.close()
+        locations = [{
+            'location_id': x[0],
+            'location_name': x[1],
+            'lat': x[2],
+            'lng': x[3],
+            'has_rc_people': True
+        } for x in cursor.fetchall()]
+        cursor.close()
 
     return jsonify(locations)
 
@@ -175,8 +322,133 @@ def get_all_rc_locations():
 @app.route('/api/locations/all')
 @needs_authorization
 def get_all_rc_locations_with_people():
-    cursor = connection.cursor()
+    """Returns all locations in the database
+    with their geolocation data and all affiliated RC users.
+
+    With ?batch=, ?stint_type=, ?from= or ?to=, only RC users with a
+    matching stint are included (see parse_stint_filters).
+
+    With ?fields=summary, each location only carries its counts,
+    and its people can be fetched from /api/locations/<id>/people.
+
+    With ?format=columnar or ?format=msgpack, or the matching Accept
+    header, the data is sent in the compact encoding from columnar.py."""
+    fields = request.args.get('fields', 'full')
+    if fields not in LOCATION_LOADERS:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': f"Unknown fields value '{fields}'",
+        }), 400)
+
+    payload_format = get_payload_format()
+    if payload_format not in PAYLOAD_ENCODERS:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': f"Unknown format value '{payload_format}'",
+        }), 400)
+
+    try:
+        filters = parse_stint_filters(request.args)
+    except ValueError:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': 'from and to must be dates (YYYY-MM-DD)',
+        }), 400)
+
+    if filters:
+        # Filtered views are built on demand rather than cached
+        with db_pool.connection() as connection:
+            cursor = connection.cursor()
+            locations = get_filtered_locations(cursor, filters, fields)
+            cursor.close()
+        response = PAYLOAD_ENCODERS[payload_format](locations).response()
+        response.vary.add('Accept')
+        return response
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        version = get_dataset_version(cursor)
+        cursor.close()
+    payload = payload_cache.get((fields, payload_format), version,
+                                lambda: build_payload(fields, payload_format))
+
+    response = payload.response()
+    response.vary.add('Accept')
+    response.headers['X-Dataset-Version'] = str(version)
+    return response
+
+
+def build_payload(fields, payload_format):
+    """Loads and encodes the /api/locations/all payload, returning the
+    database connection before the slower encoding starts."""
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        locations = LOCATION_LOADERS[fields](cursor)
+        cursor.close()
+    return PAYLOAD_ENCODERS[payload_format](locations)
+
+
+def get_payload_format():
+    "Returns the payload format asked for by ?format= or the Accept header."
+    if 'format' in request.args:
+        return request.args['format']
+    mimetype = request.accept_mimetypes.best_match(PAYLOAD_MIMETYPES, 'application/json')
+    return PAYLOAD_MIMETYPES[mimetype]
+
+
+@app.route('/api/locations/changes')
+@needs_authorization
+def get_location_changes():
+    """Returns the locations added or changed since dataset version
+    ?since=, as /api/locations/all would serve them, and the ids of the
+    ones removed. Pass the returned version as ?since= next time.
+
+    If the changes since that version are no longer kept,
+    full_reload is true and /api/locations/all has to be fetched again."""
+    fields = request.args.get('fields', 'full')
+    since = request.args.get('since', type=int)
+    if since is None or fields not in LOCATION_LOADERS:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': 'since must be a dataset version, and fields full or summary',
+        }), 400)
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        cursor.execute("""SELECT version, compacted_through
+                          FROM dataset_version""")
+        version, compacted_through = cursor.fetchone()
+        if since < compacted_through or since > version:
+            cursor.close()
+            return jsonify({
+                'version': version,
+                'full_reload': True,
+            })
+
+        cursor.execute("""SELECT DISTINCT location_id
+                          FROM location_changes
+                          WHERE version > %s""", [since])
+        location_ids = [x[0] for x in cursor.fetchall()]
+        changed = LOCATION_LOADERS[fields](cursor, location_ids) if location_ids else []
+        cursor.close()
+
+    found = {location['location_id'] for location in changed}
+    return jsonify({
+        'version': version,
+        'full_reload': False,
+        'changed': changed,
+        'removed': sorted(set(location_ids) - found),
+    })
+
 
+def get_dataset_version(cursor):
+    "Returns the version number of the data currently in the database."
+    cursor.execute("SELECT version FROM dataset_version")
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def get_locations_with_people(cursor, location_ids=None):
     # Query returns list of locations grouped in the format:
     # {
     #   location_id:
@@ -203,7 +475,7 @@ def get_all_rc_locations_with_people():
     #   ]
     # }
 
-    """Returns all locations in the database
+    """Returns all locations in the database, or those in `location_ids`,
     with their geolocation data and all affiliated RC users."""
     cursor.execute("""SELECT
                         location_id,
@@ -214,9 +486,12 @@ def get_all_rc_locations_with_people():
                         city_count,
                         total_population,
                         person_list
-                      FROM geolocations_people_and_stints_agg""")
+                      FROM geolocations_people_and_stints_agg
+                      WHERE %(all)s OR location_id = ANY(%(ids)s)
+                      ORDER BY location_id""",
+                   {'all': location_ids is None, 'ids': location_ids or []})
 
-    locations = [{
+    return [{
         'location_id': x[0],
         'location_name': x[1],
         'type': x[2],
@@ -227,82 +502,707 @@ def get_all_rc_locations_with_people():
         'has_rc_people': True,
         'person_list': x[7]
     } for x in cursor.fetchall()]
-    cursor.close()
 
+
+def get_location_summaries(cursor, location_ids=None):
+    """Returns all locations with RC people, or those in `location_ids`,
+    and their geolocation data, with a count of affiliated RC users in
+    place of the person list."""
+    cursor.execute("""SELECT
+                        location_id,
+                        location_name,
+                        type,
+                        lat,
+                        lng,
+                        city_count,
+                        total_population,
+                        json_array_length(person_list)
+                      FROM geolocations_people_and_stints_agg
+                      WHERE %(all)s OR location_id = ANY(%(ids)s)
+                      ORDER BY location_id""",
+                   {'all': location_ids is None, 'ids': location_ids or []})
+
+    return [{
+        'location_id': x[0],
+        'location_name': x[1],
+        'type': x[2],
+        'lat': x[3],
+        'lng': x[4],
+        'city_count': x[5],
+        'total_population': x[6],
+        'has_rc_people': True,
+        'person_count': x[7]
+    } for x in cursor.fetchall()]
+
+
+LOCATION_LOADERS = {
+    'full': get_locations_with_people,
+    'summary': get_location_summaries,
+}
+
+
+def parse_stint_filters(args):
+    """Returns the stint filters in the query string, or None if there are
+    none. People match if one of their stints is in batch ?batch= (short
+    or full name), is of type ?stint_type=, and is under way at some point
+    between ?from= and ?to=, both dates. Raises ValueError for bad dates."""
+    filters = {name: args.get(name) or None
+               for name in ('batch', 'stint_type', 'from', 'to')}
+    if not any(filters.values()):
+        return None
+
+    for name in ('from', 'to'):
+        if filters[name]:
+            filters[name] = date.fromisoformat(filters[name])
+    return filters
+
+
+# The RC users who have a stint matching the filters, where they are,
+# and how many of them there are in each country
+FILTERED_PEOPLE_CTES = """
+    WITH matching_people AS (
+      SELECT DISTINCT person_id
+      FROM stints
+      WHERE (%(batch)s IS NULL OR batch_id = ANY(ARRAY(
+          SELECT batch_id
+          FROM batches
+          WHERE short_name = %(batch)s OR name = %(batch)s)))
+        AND (%(stint_type)s IS NULL OR stint_type = %(stint_type)s)
+        AND (%(to)s IS NULL OR start_date <= %(to)s)
+        AND (%(from)s IS NULL OR COALESCE(end_date, 'infinity') >= %(from)s)
+    ), located_people AS (
+      SELECT
+        l.location_id,
+        l.name AS location_name,
+        l.type,
+        l.lat,
+        l.lng,
+        l.country_code,
+        p.person_id,
+        p.name AS person_name,
+        p.image_url
+      FROM matching_people m
+      INNER JOIN location_affiliations a
+        ON a.person_id = m.person_id
+      INNER JOIN geolocations l
+        ON l.location_id = a.location_id
+      INNER JOIN people p
+        ON p.person_id = m.person_id
+    ), country_counts AS (
+      SELECT
+        a.location_id,
+        COUNT(DISTINCT b.location_id) FILTER (WHERE b.type = 'city') AS city_count,
+        COUNT(*) AS total_population
+      FROM geolocations a
+      INNER JOIN located_people b
+        ON b.country_code = a.country_code
+      WHERE a.type = 'country'
+      GROUP BY a.location_id
+    )"""
+
+# Locations with the RC users who have a stint matching the filters,
+# aggregated the same way as geolocations_people_and_stints_agg
+FILTERED_LOCATIONS = FILTERED_PEOPLE_CTES + """
+    SELECT
+      p.location_id,
+      p.location_name,
+      p.type,
+      p.lat,
+      p.lng,
+      COALESCE(c.city_count, 0),
+      COALESCE(c.total_population, 0),
+      {people}
+    FROM located_people p
+    LEFT JOIN country_counts c
+      ON c.location_id = p.location_id
+    WHERE %(all)s OR p.location_id = ANY(%(ids)s)
+    GROUP BY p.location_id, p.location_name, p.type, p.lat, p.lng,
+      c.city_count, c.total_population
+    ORDER BY p.location_id"""
+
+# The person column of each ?fields= value
+FILTERED_PEOPLE = {
+    'full': ('person_list', """json_agg(
+          json_build_object(
+            'person_id', p.person_id,
+            'name', p.person_name,
+            'image_url', p.image_url,
+            'stints', (
+              SELECT json_agg(
+                json_build_object(
+                  'stint_type', st.stint_type,
+                  'rc_title', st.title,
+                  'batch_name', b.short_name,
+                  'start_date', st.start_date
+                )
+                ORDER BY st.start_date
+              )
+              FROM stints st
+              LEFT JOIN batches b
+                ON b.batch_id = st.batch_id
+              WHERE st.person_id = p.person_id
+            )
+          )
+          ORDER BY p.person_name, p.person_id
+        )"""),
+    'summary': ('person_count', "COUNT(*)"),
+}
+
+
+def get_filtered_locations(cursor, filters, fields='full', location_ids=None):
+    """Returns the locations with RC users who match the stint filters,
+    or those of them in `location_ids`, in the same form as the
+    LOCATION_LOADERS, counting only the matching people."""
+    people_field, people_column = FILTERED_PEOPLE[fields]
+    cursor.execute(FILTERED_LOCATIONS.format(people=people_column),
+                   {**filters, 'all': location_ids is None, 'ids': location_ids or []})
+
+    return [{
+        'location_id': x[0],
+        'location_name': x[1],
+        'type': x[2],
+        'lat': x[3],
+        'lng': x[4],
+        'city_count': x[5],
+        'total_population': x[6],
+        'has_rc_people': True,
+        people_field: x[7]
+    } for x in cursor.fetchall()]
+
+
+def get_filtered_country_counts(cursor, filters, location_id):
+    """Returns the city_count and total_population of a country, counting
+    only the RC users who match the stint filters."""
+    cursor.execute(FILTERED_PEOPLE_CTES + """
+        SELECT city_count, total_population
+        FROM country_counts
+        WHERE location_id = %(id)s""", {**filters, 'id': location_id})
+    counts = cursor.fetchone() or (0, 0)
+    return {'city_count': counts[0], 'total_population': counts[1]}
+
+
+PAYLOAD_ENCODERS = {
+    'json': EncodedPayload.from_json,
+    'columnar': lambda data: EncodedPayload.from_json(columnar.encode(data),
+                                                      columnar.JSON_MIMETYPE),
+}
+# Plain JSON comes first, so it wins for clients that accept anything
+PAYLOAD_MIMETYPES = {
+    'application/json': 'json',
+    columnar.JSON_MIMETYPE: 'columnar',
+}
+if msgpack:
+    PAYLOAD_ENCODERS['msgpack'] = lambda data: EncodedPayload(
+        msgpack.packb(columnar.encode(data)), columnar.MSGPACK_MIMETYPE)
+    PAYLOAD_MIMETYPES.update({
+        columnar.MSGPACK_MIMETYPE: 'msgpack',
+        'application/msgpack': 'msgpack',
+        'application/x-msgpack': 'msgpack',
+    })
+
+
+@app.route('/api/locations/<int:id>/people')
+@needs_authorization
+def get_location_people(id):
+    """Returns one page of the RC users affiliated with a location,
+    ordered by name. Pass the returned next_cursor to get the next page."""
+    try:
+        limit = min(max(int(request.args.get('limit', '50')), 1), 200)
+        after = decode_cursor(request.args.get('cursor'))
+    except ValueError as e:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': str(e),
+        }), 400)
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        id = get_alias(cursor, id) or id
+        people = get_people_page(cursor, id, after, limit + 1)
+        cursor.close()
+
+    next_cursor = None
+    if len(people) > limit:
+        people = people[:limit]
+        next_cursor = encode_cursor(people[-1]['name'], people[-1]['person_id'])
+
+    return jsonify({
+        'location_id': id,
+        'person_list': people,
+        'next_cursor': next_cursor,
+    })
+
+
+def encode_cursor(name, person_id):
+    "Returns an opaque pagination cursor for the given sort key."
+    key = json.dumps([name, person_id]).encode('utf-8')
+    return base64.urlsafe_b64encode(key).decode('ascii')
+
+
+def decode_cursor(value):
+    "Returns the (name, person_id) sort key in a cursor, or None if empty."
+    if not value:
+        return None
+    try:
+        name, person_id = json.loads(base64.urlsafe_b64decode(value))
+        return str(name), int(person_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor '{value}'") from e
+
+
+def get_people_page(cursor, location_id, after, limit):
+    """Returns up to `limit` people affiliated with the location, with their
+    stints, sorted after the (name, person_id) key `after` if given."""
+    keyset = "AND (p.name, p.person_id) > (%s, %s)" if after else ""
+    cursor.execute("""SELECT
+                        p.person_id,
+                        p.name,
+                        p.image_url,
+                        s.stints
+                      FROM location_affiliations a
+                      INNER JOIN people p
+                        ON p.person_id = a.person_id
+                      CROSS JOIN LATERAL (
+                        SELECT
+                          json_agg(
+                            json_build_object(
+                              'stint_type', stint_type,
+                              'rc_title', rc_title,
+                              'batch_name', batch_name,
+                              'start_date', start_date
+                            )
+                            ORDER BY start_date
+                          ) AS stints
+                        FROM stints_for_people
+                        WHERE person_id = p.person_id
+                      ) s
+                      WHERE a.location_id = %s
+                        AND s.stints IS NOT NULL
+                      """ + keyset + """
+                      ORDER BY p.name, p.person_id
+                      LIMIT %s""",
+                   [location_id, *(after or []), limit])
+
+    return [{
+        'person_id': x[0],
+        'name': x[1],
+        'image_url': x[2],
+        'stints': x[3]
+    } for x in cursor.fetchall()]
+
+
+@app.route('/api/locations/clusters')
+@needs_authorization
+def get_location_clusters():
+    """Returns the clusters of RC locations visible in a bounding box
+    at a map zoom level, with the number of RCers in each."""
+    try:
+        bbox = parse_bbox(request.args.get('bbox', '-180,-90,180,90'))
+        zoom = int(request.args.get('zoom', '0'))
+    except ValueError as e:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': str(e),
+        }), 400)
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        version = get_dataset_version(cursor)
+        index = index_cache.get(
+            'clusters', version,
+            lambda: ClusterIndex(get_location_populations(cursor)))
+        cursor.close()
+
+    return jsonify([c.to_json() for c in index.query(*bbox, zoom)])
+
+
+def get_location_populations(cursor):
+    """Returns the id, coordinates and number of RCers
+    for each location with RC people."""
+    cursor.execute("""SELECT
+                        location_id,
+                        lat,
+                        lng,
+                        json_array_length(person_list)
+                      FROM geolocations_people_and_stints_agg""")
+
+    return [(x[0], float(x[1]), float(x[2]), x[3]) for x in cursor.fetchall()]
+
+
+@app.route('/api/locations/nearby')
+@needs_authorization
+def get_nearby_locations():
+    """Returns the RC locations within ?radius_km= of a point, nearest
+    first, each with its RC users and its distance_km, or with ?k= only
+    the k nearest of them. The point is ?lat=&lng=, or the location ?id=.
+    Takes ?fields= like /api/locations/all."""
+    fields = request.args.get('fields', 'full')
+    try:
+        center_id, lat, lng, radius_km, k = parse_nearby_query(request.args)
+        if fields not in LOCATION_LOADERS:
+            raise ValueError(f"Unknown fields value '{fields}'")
+    except ValueError as e:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': str(e),
+        }), 400)
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        if center_id is not None:
+            center = get_location_document(cursor, center_id)
+            if not center:
+                cursor.close()
+                return (jsonify({
+                    'message': 'Not Found',
+                    'error': f'Location {center_id} has not been geocoded',
+                }), 404)
+            lat, lng = center['lat'], center['lng']
+
+        version = get_dataset_version(cursor)
+        index = index_cache.get(
+            'nearby', version,
+            lambda: SpatialIndex(get_location_points(cursor)))
+        if k is None:
+            nearby = index.within(lat, lng, radius_km)
+        else:
+            nearby = index.nearest(lat, lng, k, radius_km)
+
+        distances = {location_id: distance for distance, location_id in nearby}
+        locations = LOCATION_LOADERS[fields](cursor, list(distances)) if distances else []
+        cursor.close()
+
+    for location in locations:
+        location['distance_km'] = round(distances[location['location_id']], 3)
+    locations.sort(key=lambda l: (l['distance_km'], l['location_id']))
     return jsonify(locations)
 
 
+# Radius of /api/locations/nearby when neither radius_km nor k is given
+DEFAULT_NEARBY_RADIUS_KM = 50.0
+MAX_NEARBY_LOCATIONS = 100
+
+
+def parse_nearby_query(args):
+    """Returns (location id, lat, lng, radius_km, k) for a nearby query;
+    either the id or the coordinates are None. Raises ValueError if the
+    query is malformed."""
+    k = args.get('k', type=int)
+    if 'k' in args and not (k and 0 < k <= MAX_NEARBY_LOCATIONS):
+        raise ValueError(f"k must be a number from 1 to {MAX_NEARBY_LOCATIONS}")
+
+    radius_km = args.get('radius_km', type=float)
+    if radius_km is None:
+        if 'radius_km' in args:
+            raise ValueError("radius_km must be a number")
+        radius_km = MAX_DISTANCE_KM if k else DEFAULT_NEARBY_RADIUS_KM
+    if not 0 <= radius_km < math.inf:
+        raise ValueError("radius_km can't be negative")
+
+    if 'id' in args:
+        location_id = args.get('id', type=int)
+        if location_id is None:
+            raise ValueError("id must be a location id")
+        return location_id, None, None, radius_km, k
+
+    lat, lng = args.get('lat', type=float), args.get('lng', type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError("Expected a location id, or a lat and lng")
+    return None, lat, lng, radius_km, k
+
+
+def get_location_points(cursor):
+    """Returns the id and coordinates of each city or region with
+    RC people. Countries are left out, as their coordinates are
+    only a rough centre."""
+    cursor.execute("""SELECT
+                        location_id,
+                        lat,
+                        lng
+                      FROM geolocations_people_and_stints_agg
+                      WHERE type <> 'country'""")
+
+    return [(x[0], float(x[1]), float(x[2])) for x in cursor.fetchall()]
+
+
 @app.route('/api/locations/search')
 def locations_search():
+    """Returns location suggestions for a search query, ranked by the
+    number of RCers in each. Locations the database doesn't know yet are
+    looked up in the RC API, whose answers are cached."""
     suggestions = []
     q = request.args.get('query')
+    limit = 10
 
-    if (q == ""):
+    key = normalize(q)
+    if (key == ""):
         return jsonify(suggestions)
 
-    headers = {'Authorization': f'Bearer {token}'}
-    url = 'https://www.recurse.com/api/v1/locations?limit={limit}&query={query}'
-    limit = 10
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        version = get_dataset_version(cursor)
+        index = index_cache.get(
+            'search', version,
+            lambda: LocationSearchIndex(get_searchable_locations(cursor)))
+        cursor.close()
+
+    suggestions = [{
+        'id': x['id'],
+        'name': x['name'],
+        'short_name': x['short_name'],
+        'type': x['type'],
+    } for x in index.search(q, limit)]
+    if suggestions:
+        return jsonify(suggestions)
 
-    r = requests.get(url.format(
-        limit=limit, query=q), headers=headers)
-    if r.status_code != requests.codes['ok']:
-        r.raise_for_status()
-    suggestions = r.json()
+    suggestions = suggestion_cache.get(key)
+    if suggestions is None:
+        suggestions = search_rc_locations(q, limit)
+        suggestion_cache.set(key, suggestions)
     return jsonify(suggestions)
 
 
+def search_rc_locations(query, limit):
+    "Returns the RC API's location suggestions for a search query."
+    return rc_api.get_json('locations', params={'limit': limit, 'query': query})
+
+
+def get_searchable_locations(cursor):
+    """Returns every known location with the number of RCers there,
+    counting the people at its preferred location if it is an alias."""
+    cursor.execute("""SELECT
+                        l.location_id,
+                        l.name,
+                        l.short_name,
+                        g.type,
+                        COALESCE(p.population, 0)
+                      FROM locations l
+                      LEFT JOIN geolocations g
+                        ON g.location_id = l.location_id
+                      LEFT JOIN location_aliases a
+                        ON a.location_id = l.location_id
+                      LEFT JOIN (
+                        SELECT location_id, COUNT(*) AS population
+                        FROM location_affiliations
+                        GROUP BY location_id
+                      ) p
+                        ON p.location_id = COALESCE(a.preferred_location_id, l.location_id)""")
+
+    return [{
+        'id': x[0],
+        'name': x[1],
+        'short_name': x[2],
+        'type': x[3] or ('city' if ', ' in x[1] else 'country'),
+        'population': x[4]
+    } for x in cursor.fetchall()]
+
+
 @app.route('/api/locations/<int:id>')
 @needs_authorization
 def get_location(id):
-    cursor = connection.cursor()
-
-    # If location is aliased to another location, find preferred location
-    preferred_id = get_alias(cursor, id)
-    if (preferred_id):
-        id = preferred_id
-
-    # If geolocation data exists with people affiliated, return it
-    location = get_geolocation_with_people(cursor, id)
-    if (location):
-        return jsonify(location)
+    """Return the data for a location. A location that isn't in the database
+    yet is geocoded in the background, and 202 Accepted is returned with a
+    status URL to poll until it's ready.
 
-    # Else lookup existing geolocation info, and then return it
-    location = get_geolocation(cursor, id)
+    Takes the same stint filters as /api/locations/all."""
+    try:
+        filters = parse_stint_filters(request.args)
+    except ValueError:
+        return (jsonify({
+            'message': 'Bad Request',
+            'error': 'from and to must be dates (YYYY-MM-DD)',
+        }), 400)
+
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        location = get_location_document(cursor, id)
+        if (location and filters):
+            location = filter_location_document(cursor, location, filters)
+        cursor.close()
     if (location):
-        add_population_if_country(cursor, location)
         return jsonify(location)
 
-    # Otherwise, create and insert new location
     location_name = request.args.get('name')
-    if (location_name == ""):
+    if (not location_name):
         return jsonify({})
 
-    location = {
-        "id": id,
-        "location_id": id,
-        "name": location_name,
-        "short_name": request.args.get('short_name'),
-        "type": request.args.get('type')
+    # Requests for a location already being geocoded, by any worker,
+    # share its job
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        claimed = claim_geocode_job(cursor, id)
+        connection.commit()
+        cursor.close()
+    if (claimed):
+        geocode_jobs.submit(id, geocode_location, {
+            "id": id,
+            "location_id": id,
+            "name": location_name,
+            "short_name": request.args.get('short_name'),
+            "type": request.args.get('type')
+        })
+    return geocoding_pending(id)
+
+
+def filter_location_document(cursor, location, filters):
+    """Returns a location document with only the RC users who match
+    the stint filters, and a country's counts of them."""
+    if (location['has_rc_people']):
+        matching = get_filtered_locations(cursor, filters, 'full', [location['location_id']])
+        if (matching):
+            return matching[0]
+
+    document = {
+        'location_id': location['location_id'],
+        'location_name': location['location_name'],
+        'type': location['type'],
+        'lat': location['lat'],
+        'lng': location['lng'],
+        'has_rc_people': False
     }
+    if ('city_count' in location):
+        document.update(get_filtered_country_counts(cursor, filters, location['location_id']))
+    return document
 
-    insert_location(cursor, location)
-    connection.commit()
 
-    # If there's an existing location in the db with the same lat/lng,
-    # create an alias and use the alias' id for lookup
-    geo = lookup_geodata(cursor, location)
-    preferred_location = find_location_with_coords(cursor, geo)
-    if (preferred_location):
-        insert_alias(cursor, location, preferred_location)
-        id = preferred_location["location_id"]
+@app.route('/api/locations/<int:id>/status')
+@needs_authorization
+def get_location_status(id):
+    "Report whether a location requested from get_location has been geocoded"
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+        location = get_location_document(cursor, id)
+        job = get_geocode_job(cursor, id)
+        cursor.close()
+    if (location):
+        return jsonify({
+            'status': 'done',
+            'location_url': url_for('get_location', id=id),
+        })
 
-    # Otherwise, insert new geolocation into database
-    insert_geo_data(cursor, geo)
-    connection.commit()
+    if (job is None):
+        return (jsonify({
+            'message': 'Not Found',
+            'status': 'unknown',
+        }), 404)
 
-    # Retrieve location by id now that db has been updated
-    return get_location(id)
+    status, error, stale = job
+    if (status == 'pending' and not stale):
+        return geocoding_pending(id)
+
+    return jsonify({
+        'status': 'failed',
+        'error': error or 'Geocoding did not finish',
+    })
+
+
+def geocoding_pending(id):
+    status_url = url_for('get_location_status', id=id)
+    return (jsonify({
+        'status': 'pending',
+        'status_url': status_url,
+    }), 202, {'Location': status_url, 'Retry-After': '1'})
+
+
+# Takes the job for a location unless another worker holds it. Failed
+# jobs, and pending ones that have gone quiet, are taken over.
+CLAIM_GEOCODE_JOB = """
+INSERT INTO geocode_jobs (location_id, status)
+VALUES (%(id)s, 'pending')
+ON CONFLICT (location_id) DO UPDATE
+SET status = 'pending', error = NULL, started_at = now()
+WHERE geocode_jobs.status = 'failed'
+   OR geocode_jobs.started_at < now() - %(timeout)s * INTERVAL '1 second'
+RETURNING location_id
+"""
+
+
+def claim_geocode_job(cursor, location_id):
+    "Returns True if this worker should geocode the location."
+    cursor.execute(CLAIM_GEOCODE_JOB, {
+        'id': location_id,
+        'timeout': geocode_job_timeout,
+    })
+    return cursor.fetchone() is not None
+
+
+def get_geocode_job(cursor, location_id):
+    "Returns (status, error, stale) for a location's geocoding job, or None."
+    cursor.execute("""
+        SELECT status, error,
+               started_at < now() - %(timeout)s * INTERVAL '1 second'
+        FROM geocode_jobs
+        WHERE location_id = %(id)s
+    """, {'id': location_id, 'timeout': geocode_job_timeout})
+    return cursor.fetchone()
+
+
+def finish_geocode_job(cursor, location_id, error=None):
+    """Forgets a finished job, whose location document now answers for
+    it, or records why it failed."""
+    if (error is None):
+        cursor.execute("DELETE FROM geocode_jobs WHERE location_id = %s",
+                       (location_id,))
+    else:
+        cursor.execute("""
+            UPDATE geocode_jobs SET status = 'failed', error = %s
+            WHERE location_id = %s
+        """, (error, location_id))
+
+
+def geocode_location(location):
+    """Runs create_location for a claimed job and records the outcome in
+    the database, where every worker can report it."""
+    error = None
+    try:
+        document = create_location(location)
+        if (not document):
+            error = 'No geocode found'
+        return document
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        raise
+    finally:
+        with db_pool.connection() as connection:
+            finish_geocode_job(connection.cursor(), location["id"], error)
+            connection.commit()
+
+
+def create_location(location):
+    """Geocodes and stores a new location, then returns its data. Runs in
+    a background job with its own database connection."""
+    with db_pool.connection() as connection:
+        cursor = connection.cursor()
+
+        # Another process may have stored it in the meantime
+        document = get_location_document(cursor, location["id"])
+        if (document):
+            return document
+
+        insert_location(cursor, location)
+        connection.commit()
+
+        # If there's an existing location in the db with the same lat/lng,
+        # create an alias and use the alias' id for lookup
+        id = location["id"]
+        try:
+            geo = lookup_geodata(cursor, location)
+        except (KeyError, TypeError):
+            logging.warning("No geocode found for %s", location["name"])
+            return None
+        preferred_location = find_location_with_coords(cursor, geo)
+        if (preferred_location):
+            insert_alias(cursor, location, preferred_location)
+            id = preferred_location["location_id"]
+
+        # Otherwise, insert new geolocation into database
+        insert_geo_data(cursor, geo)
+        refresh_aggregates(cursor)
+        bump_dataset_version(cursor)
+        connection.commit()
+
+        # Retrieve location by id now that db has been updated
+        return get_location_document(cursor, id)
 
 
 @app.route('/api/me/')
@@ -326,11 +1226,9 @@ def get_current_user():
 
 
 def get_alias(cursor, location_id):
-    logging.info("Select Alias for Location ID #{}".format(
-        location_id
-    ))
     """Returns the preferred location alias for the location
         with the given id if an alias exists."""
+    logging.info("Select Alias for Location ID #%s", location_id)
     cursor.execute("""SELECT
                         preferred_location_id
                       FROM location_aliases
@@ -342,32 +1240,17 @@ def get_alias(cursor, location_id):
 
 
 def find_location_with_coords(cursor, location):
-    """Searches database for a location with lat/lng values matching those of the given location."""
-    cursor.execute("""SELECT
-                        location_id,
-                        name,
-                        lat,
-                        lng
-                      FROM geolocations
-                      WHERE lat = %s
-                      AND lng = %s
-                      AND NOT location_id = %s""",
-                   [location["lat"], location["lng"], location["location_id"]])
-
-    results = [{
-        'location_id': x[0],
-        'location_name': x[1]
-    } for x in cursor.fetchall()]
-
-    return require_one(results, location["location_id"])
+    """Searches database for a location with lat/lng values within the
+    coordinate tolerance of those of the given location."""
+    return find_nearby_location(cursor, location["lat"], location["lng"],
+                                location["location_id"]) or {}
 
 
 def insert_location(cursor, location):
-    logging.info("Insert Location #{}: {} ({})".format(
-        location.get('id'),
-        location.get('name'),
-        location.get('short_name')
-    ))
+    logging.info("Insert Location #%s: %s (%s)",
+                 location.get('id'),
+                 location.get('name'),
+                 location.get('short_name'))
     cursor.execute("INSERT INTO locations" +
                    " (location_id, name, short_name)" +
                    " VALUES (%s, %s, %s)" +
@@ -380,93 +1263,9 @@ def insert_location(cursor, location):
                    )
 
 
-def get_geolocation(cursor, location_id):
-    logging.info("Select Location By ID #{}".format(
-        location_id
-    ))
-    """Returns the requested geolocation data for a location with the given id."""
-    cursor.execute("""SELECT
-                        location_id,
-                        name,
-                        type,
-                        lat,
-                        lng
-                      FROM geolocations
-                      WHERE location_id = %s""", [location_id])
-
-    x = cursor.fetchone()
-
-    return {
-        'location_id': x[0],
-        'location_name': x[1],
-        'type': x[2],
-        'lat': x[3],
-        'lng': x[4],
-        'has_rc_people': False
-    } if x else {}
-
-
-def get_geolocation_with_people(cursor, location_id):
-    logging.info("Select Location By ID #{}".format(
-        location_id
-    ))
-    """Returns the requested geolocation data for a location with the given id."""
-    cursor.execute("""SELECT
-                        location_id,
-                        location_name,
-                        type,
-                        lat,
-                        lng,
-                        city_count,
-                        total_population,
-                        person_list
-                      FROM geolocations_people_and_stints_agg
-                      WHERE location_id = %s""", [location_id])
-    locations = [{
-        'location_id': x[0],
-        'location_name': x[1],
-        'type': x[2],
-        'lat': x[3],
-        'lng': x[4],
-        'city_count': x[5],
-        'total_population': x[6],
-        'has_rc_people': True,
-        'person_list': x[7]
-    } for x in cursor.fetchall()]
-
-    return require_one(locations, location_id)
-
-
-def add_population_if_country(cursor, location):
-    if (location["type"] == 'city'):
-        return
-
-    location_id = location["location_id"]
-    logging.info("Select Country Population, ID #{}".format(
-        location_id
-    ))
-    """Returns the population and city counts for the country with the given id."""
-    cursor.execute("""SELECT
-                        location_id,
-                        city_count,
-                        total_population
-                      FROM geolocations_popl_by_country_agg
-                      WHERE location_id = %s""", [location_id])
-    locations = [{
-        'location_id': x[0],
-        'city_count': x[1],
-        'total_population': x[2]
-    } for x in cursor.fetchall()]
-
-    population_data = require_one(locations, location_id)
-    location.update(population_data)
-
-
-def require_one(location_arr, location_id):
-    if (len(location_arr) == 0):
-        return {}
-    if (len(location_arr) == 1):
-        return location_arr[0]
-
-    # Otherwise, throw error - Result should be <= 1
-    raise ValueError("Multiple locations returned for id " + location_id)
+def get_location_document(cursor, location_id):
+    """Returns the data served for the location with the given id, or
+    None if it has no geolocation yet, using a single query."""
+    logging.info("Select Location By ID #%s", location_id)
+    cursor.execute("SELECT location_document(%s)", [location_id])
+    return cursor.fetchone()[0]